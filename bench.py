@@ -0,0 +1,894 @@
+"""Offline benchmarks for main.py
+
+Runs against local stand-ins only, no Telegram or internet needed.
+
+    python bench.py health --jobs 8
+    python bench.py hls --segments 200 --latency 0.05
+    python bench.py segmented --size-mb 64 --rate-mb 4
+    python bench.py parse --lines 100000 --html-mb 50
+    python bench.py cancel --kind video --after 1
+    python bench.py tuning --jobs 10 --limit 10
+    python bench.py workers --videos 4 --encrypt
+    python bench.py e2e --videos 4 --docs 8 --images 8
+    python bench.py upload --size-mb 256 --workers 1 2 4 8 16
+    python bench.py media --minutes 30
+    python bench.py scale --workers 1 2 4 --batches 8
+"""
+import argparse
+import asyncio
+import io
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from types import SimpleNamespace
+
+from aiohttp import web
+
+import main
+
+
+def media_cmd(seconds: float) -> list:
+    """A busy ffmpeg job if ffmpeg exists, otherwise a CPU-bound stand-in"""
+    if shutil.which('ffmpeg'):
+        return [
+            'ffmpeg', '-v', 'quiet', '-f', 'lavfi',
+            '-i', f'testsrc=duration={seconds}:size=1280x720:rate=30',
+            '-f', 'null', '-'
+        ]
+    return [sys.executable, '-c', f'import time\nend = time.time() + {seconds}\nwhile time.time() < end: pass']
+
+
+async def start_site(app: web.Application, port: int = 0):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}'
+
+
+def hls_origin(segments: int, seg_kb: int, latency: float, encrypt: bool,
+               max_parallel: int = 0) -> web.Application:
+    """Master + media playlists with generated segments, optionally AES-128
+
+    With max_parallel set, segment requests beyond that many in flight get 429.
+    """
+    payload = os.urandom(seg_kb * 1024)
+    key = os.urandom(16)
+    if encrypt:
+        from Cryptodome.Cipher import AES
+        pad = 16 - len(payload) % 16
+        body = AES.new(key, AES.MODE_CBC, bytes(16)).encrypt(payload + bytes([pad]) * pad)
+    else:
+        body = payload
+
+    master = ['#EXTM3U']
+    for height, bw in ((360, 800000), (720, 2500000), (1080, 5000000)):
+        master += [f'#EXT-X-STREAM-INF:BANDWIDTH={bw},RESOLUTION={height * 16 // 9}x{height}', f'v{height}.m3u8']
+
+    media = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:4', '#EXT-X-MEDIA-SEQUENCE:0']
+    if encrypt:
+        media.append('#EXT-X-KEY:METHOD=AES-128,URI="key.bin",IV=0x' + '00' * 16)
+    for i in range(segments):
+        media += ['#EXTINF:4.0,', f'seg{i}.ts']
+    media.append('#EXT-X-ENDLIST')
+
+    async def master_h(request):
+        return web.Response(text='\n'.join(master), content_type='application/vnd.apple.mpegurl')
+
+    async def media_h(request):
+        return web.Response(text='\n'.join(media), content_type='application/vnd.apple.mpegurl')
+
+    in_flight = 0
+
+    async def seg_h(request):
+        nonlocal in_flight
+        if max_parallel and in_flight >= max_parallel:
+            return web.Response(status=429)
+        in_flight += 1
+        try:
+            await asyncio.sleep(latency)
+        finally:
+            in_flight -= 1
+        return web.Response(body=body, content_type='video/mp2t')
+
+    async def key_h(request):
+        return web.Response(body=key)
+
+    app = web.Application()
+    app.router.add_get('/master.m3u8', master_h)
+    app.router.add_get('/v{height}.m3u8', media_h)
+    app.router.add_get('/seg{n}.ts', seg_h)
+    app.router.add_get('/key.bin', key_h)
+    return app
+
+
+def throttled_origin(size: int, rate: float) -> web.Application:
+    """One file with Range support, each connection capped at rate bytes/s"""
+    body = os.urandom(size)
+
+    async def file_h(request):
+        start, end = 0, size - 1
+        status = 200
+        rng = request.headers.get('Range')
+        if rng:
+            first, _, last = rng[6:].partition('-')
+            start, end = int(first), int(last) if last else size - 1
+            status = 206
+        resp = web.StreamResponse(status=status, headers={
+            'Accept-Ranges': 'bytes',
+            'ETag': '"bench"',
+            'Content-Length': str(end - start + 1),
+        })
+        if status == 206:
+            resp.headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        await resp.prepare(request)
+        if request.method == 'HEAD':
+            return resp
+        chunk = 64 * 1024
+        try:
+            for pos in range(start, end + 1, chunk):
+                await resp.write(body[pos:min(pos + chunk, end + 1)])
+                await asyncio.sleep(chunk / rate)
+        except ConnectionResetError:
+            # Client dropped the probe stream to switch to ranges
+            pass
+        return resp
+
+    app = web.Application()
+    app.router.add_get('/file.bin', file_h)
+    app.router.add_get('/video.mp4', file_h)
+    app.router.add_get('/doc.pdf', file_h)
+    app.router.add_get('/image.jpg', file_h)
+    return app, body
+
+
+class NullMessage:
+    """Stands in for a pyrogram Message, replies and uploads go nowhere"""
+
+    def __init__(self, msg_id: int = 1):
+        self.id = msg_id
+        self.chat = type('Chat', (), {'id': 0})()
+
+    async def edit_text(self, text, **kwargs):
+        return self
+
+    async def delete(self):
+        pass
+
+    async def reply_text(self, text, **kwargs):
+        return NullMessage(self.id + 1)
+
+    async def _upload(self, media, **kwargs):
+        return NullMessage(self.id + 1)
+
+    reply_video = reply_photo = reply_document = reply_animation = _upload
+
+
+class NullCallback:
+    def __init__(self, user_id: int, data: str):
+        self.from_user = type('User', (), {'id': user_id})()
+        self.data = data
+        self.message = NullMessage()
+
+    async def answer(self, *args, **kwargs):
+        pass
+
+
+class RecordingClient:
+    """Fake pyrogram Client: counts API calls and paces uploads like a real link
+
+    Messages created through it share the call counter. Uploads sleep for
+    latency plus size / upload_rate and come back with a fake file_id.
+    """
+
+    def __init__(self, latency: float = 0.0, upload_rate: float = 0.0, shared_link: bool = False):
+        self.latency = latency
+        self.upload_rate = upload_rate
+        self.calls = Counter()
+        self.uploaded_bytes = 0
+        self.ids = 0
+        # One NIC: concurrent uploads split upload_rate instead of each getting it
+        self.link = asyncio.Lock() if shared_link else None
+
+    def message(self) -> 'RecordingMessage':
+        self.ids += 1
+        return RecordingMessage(self, self.ids)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls['send_message'] += 1
+        return self.message()
+
+
+class RecordingMessage:
+    def __init__(self, client: RecordingClient, msg_id: int):
+        self.client = client
+        self.id = msg_id
+        self.chat = SimpleNamespace(id=0)
+
+    async def edit_text(self, text, **kwargs):
+        self.client.calls['edit_text'] += 1
+        return self
+
+    async def delete(self):
+        self.client.calls['delete'] += 1
+
+    async def reply_text(self, text, **kwargs):
+        self.client.calls['reply_text'] += 1
+        return self.client.message()
+
+    async def _upload(self, method: str, kind: str, media, **kwargs):
+        client = self.client
+        client.calls[method] += 1
+        size = 0
+        if isinstance(media, io.BytesIO):
+            size = media.getbuffer().nbytes
+        elif isinstance(media, str) and os.path.exists(media):
+            size = os.path.getsize(media)
+        transfer = size / client.upload_rate if client.upload_rate else 0
+        if client.link:
+            await asyncio.sleep(client.latency)
+            async with client.link:
+                await asyncio.sleep(transfer)
+        else:
+            await asyncio.sleep(client.latency + transfer)
+        client.uploaded_bytes += size
+        sent = client.message()
+        setattr(sent, kind, SimpleNamespace(file_id=f'{kind}-{sent.id}'))
+        return sent
+
+    async def reply_video(self, media, **kwargs):
+        return await self._upload('reply_video', 'video', media, **kwargs)
+
+    async def reply_photo(self, media, **kwargs):
+        return await self._upload('reply_photo', 'photo', media, **kwargs)
+
+    async def reply_document(self, media, **kwargs):
+        return await self._upload('reply_document', 'document', media, **kwargs)
+
+    async def reply_animation(self, media, **kwargs):
+        return await self._upload('reply_animation', 'animation', media, **kwargs)
+
+
+def report(name: str, samples: list):
+    samples = sorted(samples)
+    # Nearest rank, truncating put the p95 of a 2-sample run on its fastest sample
+    p95 = samples[min(len(samples) - 1, math.ceil(0.95 * len(samples)) - 1)]
+    print(f"{name}: n={len(samples)} p50={statistics.median(samples):.2f}ms "
+          f"p95={p95:.2f}ms max={samples[-1]:.2f}ms")
+
+
+async def bench_health(args):
+    """Liveness route latency while media jobs run through run_media_tool"""
+    runner, base = await start_site(main.web_app)
+    session = main.get_http_session()
+
+    async def probe(n: int) -> list:
+        samples = []
+        statuses = Counter()
+        for _ in range(n):
+            t = time.perf_counter()
+            # Liveness route: /health is readiness, 503 without a Telegram connection
+            async with session.get(f'{base}/') as r:
+                await r.read()
+                statuses[r.status] += 1
+            samples.append((time.perf_counter() - t) * 1000)
+            await asyncio.sleep(0.05)
+        if set(statuses) != {200}:
+            print(f"  statuses: {dict(statuses)}, latency includes non-200 answers")
+        return samples
+
+    report('idle', await probe(20))
+
+    jobs = [asyncio.create_task(main.run_media_tool(media_cmd(args.seconds), timeout=60))
+            for _ in range(args.jobs)]
+    await asyncio.sleep(0.2)
+    report(f'{args.jobs} media jobs (pool={main.MEDIA_WORKERS})', await probe(40))
+
+    t = time.perf_counter()
+    for job in jobs:
+        job.cancel()
+    await asyncio.gather(*jobs, return_exceptions=True)
+    print(f"cancel of in-flight jobs: {(time.perf_counter() - t) * 1000:.1f}ms")
+
+    await main.close_http_session()
+    await runner.cleanup()
+
+
+async def bench_hls(args):
+    """Native HLS segment engine vs the yt-dlp path on a local origin"""
+    runner, base = await start_site(hls_origin(args.segments, args.seg_kb, args.latency, args.encrypt))
+    url = f'{base}/master.m3u8'
+    user_id = 1
+    main.active_downloads[user_id] = True
+    total_mb = args.segments * args.seg_kb / 1024
+
+    with tempfile.TemporaryDirectory() as tmp:
+        t = time.perf_counter()
+        ok = await main.fetch_hls_stream(url, '720', os.path.join(tmp, 'native.ts'), user_id)
+        native = time.perf_counter() - t
+        print(f"native ({main.HLS_SEGMENT_WORKERS} workers): ok={ok} {native:.2f}s {total_mb / native:.1f} MB/s")
+
+        loop = asyncio.get_event_loop()
+        t = time.perf_counter()
+        ok = await loop.run_in_executor(None, main.download_video_sync, url, '720',
+                                        os.path.join(tmp, 'ytdlp'), user_id)
+        ytdlp = time.perf_counter() - t
+        print(f"yt-dlp (4 fragments): ok={ok} {ytdlp:.2f}s {total_mb / ytdlp:.1f} MB/s")
+        print(f"speedup: {ytdlp / native:.2f}x")
+
+    await main.close_http_session()
+    await runner.cleanup()
+
+
+async def bench_segmented(args):
+    """download_file throughput vs connection count on a throttled origin"""
+    app, body = throttled_origin(args.size_mb * 1024 * 1024, args.rate_mb * 1024 * 1024)
+    runner, base = await start_site(app)
+    user_id = 1
+    main.active_downloads[user_id] = True
+    main.SEGMENT_MIN_SIZE = 0
+    main.MEMORY_THRESHOLD = 0
+    baseline = None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DOWNLOAD_DIR = main.Path(tmp)
+        for n in args.connections:
+            main.SEGMENT_CONNECTIONS = n
+            t = time.perf_counter()
+            path = await main.download_file(f'{base}/file.bin', f'seg{n}.bin', NullMessage(), user_id)
+            elapsed = time.perf_counter() - t
+            with open(path, 'rb') as f:
+                ok = f.read() == body
+            os.remove(path)
+            baseline = baseline or elapsed
+            print(f"connections={n}: ok={ok} {elapsed:.2f}s {args.size_mb / elapsed:.1f} MB/s "
+                  f"({baseline / elapsed:.2f}x)")
+
+    await main.close_http_session()
+    await runner.cleanup()
+
+
+async def bench_tuning(args):
+    """Per-host fragment tuning over repeated yt-dlp jobs against a 429-limited origin"""
+    runner, base = await start_site(hls_origin(args.segments, args.seg_kb, args.latency, False, args.limit))
+    user_id = 1
+    main.active_downloads[user_id] = True
+    main.NATIVE_HLS = False
+    total_mb = args.segments * args.seg_kb / 1024
+
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DOWNLOAD_DIR = main.Path(tmp)
+        main.host_tuner = main.HostTuner(main.Path(tmp) / 'tuning.db')
+        first = None
+        for job in range(args.jobs):
+            fragments = main.host_tuner.settings('127.0.0.1')['fragments']
+            t = time.perf_counter()
+            path = await main.download_video(f'{base}/master.m3u8', '720', f'job{job}.mp4', NullMessage(), user_id)
+            elapsed = time.perf_counter() - t
+            first = first or elapsed
+            print(f"job {job}: fragments={fragments} ok={path is not None} {elapsed:.2f}s "
+                  f"{total_mb / elapsed:.1f} MB/s ({first / elapsed:.2f}x)")
+            if path:
+                os.remove(path)
+        print(main.host_tuner.summary())
+
+    await main.close_http_session()
+    await runner.cleanup()
+
+
+async def loop_lag(interval: float, samples: list, stop: asyncio.Event):
+    """Overshoot of a periodic sleep, i.e. how late the event loop runs callbacks"""
+    while not stop.is_set():
+        t = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append((time.perf_counter() - t - interval) * 1000)
+
+
+async def bench_workers(args):
+    """Event-loop lag while yt-dlp jobs run on threads vs worker processes"""
+    main.NATIVE_HLS = False
+    user_id = 1
+    main.active_downloads[user_id] = True
+
+    for processes in (0, args.videos):
+        # Fork before the origin's sockets exist, as main() does
+        main.video_pool = main.VideoPool(processes)
+        main.video_pool.start()
+        main.VIDEO_DOWNLOAD_SLOTS = args.videos
+        main.video_executor = main.ThreadPoolExecutor(max_workers=args.videos)
+        runner, base = await start_site(hls_origin(args.segments, args.seg_kb, 0.01, args.encrypt))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            main.DOWNLOAD_DIR = main.Path(tmp)
+            main.host_tuner = main.HostTuner(main.Path(tmp) / 'tuning.db')
+            samples = []
+            stop = asyncio.Event()
+            ticker = asyncio.create_task(loop_lag(0.005, samples, stop))
+            t = time.perf_counter()
+            paths = await asyncio.gather(*[
+                main.download_video(f'{base}/master.m3u8?v={i}', '720', f'v{i}.mp4', NullMessage(), user_id)
+                for i in range(args.videos)
+            ])
+            elapsed = time.perf_counter() - t
+            stop.set()
+            await ticker
+
+        label = f"{processes} processes" if processes else "threads"
+        ok = sum(p is not None for p in paths)
+        print(f"{label}: {ok}/{args.videos} videos in {elapsed:.2f}s")
+        report(f"{label} loop lag", samples)
+        await main.video_pool.shutdown()
+        await runner.cleanup()
+
+    await main.close_http_session()
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def e2e_origin(args) -> web.Application:
+    """Direct, throttled and HLS content under one local origin"""
+    direct, _ = throttled_origin(args.file_mb * 1024 * 1024, 1e12)
+    slow, _ = throttled_origin(args.file_mb * 1024 * 1024, args.rate_mb * 1024 * 1024)
+    small, _ = throttled_origin(args.image_kb * 1024, 1e12)
+    app = web.Application()
+    app.add_subapp('/direct/', direct)
+    app.add_subapp('/slow/', slow)
+    app.add_subapp('/small/', small)
+    app.add_subapp('/hls/', hls_origin(args.segments, args.seg_kb, args.latency, False))
+    return app
+
+
+def e2e_line(label: str, items: int, nbytes: int, elapsed: float, calls: Counter = None):
+    mb = nbytes / (1024 * 1024)
+    line = (f"{label}: {items} items {elapsed:.2f}s {items / elapsed:.2f} items/s "
+            f"{mb / elapsed:.1f} MB/s peak RSS {peak_rss_mb():.0f}MB")
+    if calls is not None:
+        line += f"\n  API calls: {dict(sorted(calls.items()))}"
+    print(line)
+
+
+async def bench_e2e(args):
+    """End-to-end throughput of download_file, download_video and a full quality_cb batch"""
+    # Fork video workers before the origin's sockets exist, as main() does
+    main.video_pool.start()
+    runner, base = await start_site(e2e_origin(args))
+    user_id = 1
+    main.active_downloads[user_id] = True
+    file_bytes = args.file_mb * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DOWNLOAD_DIR = main.Path(tmp)
+        main.disk_budget = main.DiskBudget(main.Path(tmp), 0)
+        main.media_cache = main.MediaCache(main.Path(tmp) / 'cache.db')
+        main.host_tuner = main.HostTuner(main.Path(tmp) / 'tuning.db')
+
+        for kind in ('direct', 'slow'):
+            client = RecordingClient()
+            t = time.perf_counter()
+            paths = await asyncio.gather(*[
+                main.download_file(f'{base}/{kind}/file.bin?i={i}', f'{kind}{i}.bin', client.message(), user_id)
+                for i in range(args.docs)
+            ])
+            elapsed = time.perf_counter() - t
+            ok = [p for p in paths if p]
+            e2e_line(f"download_file {kind}", len(ok), len(ok) * file_bytes, elapsed)
+            for p in ok:
+                if isinstance(p, str):
+                    os.remove(p)
+
+        client = RecordingClient()
+        t = time.perf_counter()
+        paths = await asyncio.gather(*[
+            main.download_video(f'{base}/hls/master.m3u8?i={i}', '720', f'v{i}.mp4', client.message(), user_id)
+            for i in range(args.videos)
+        ])
+        elapsed = time.perf_counter() - t
+        ok = [p for p in paths if p]
+        e2e_line("download_video hls", len(ok), sum(os.path.getsize(p) for p in ok), elapsed)
+        for p in ok:
+            os.remove(p)
+        del main.active_downloads[user_id]
+
+        items = (
+            [main.make_item(f'Video {i}', f'{base}/hls/master.m3u8?b={i}') for i in range(args.videos)]
+            + [main.make_item(f'Doc {i}', f'{base}/direct/doc.pdf?b={i}') for i in range(args.docs)]
+            + [main.make_item(f'Image {i}', f'{base}/small/image.jpg?b={i}') for i in range(args.images)]
+        )
+        links = os.path.join(tmp, 'links.txt')
+        open(links, 'w').close()
+        main.user_data[user_id] = {'items': items, 'file_path': links, 'range': (1, len(items))}
+
+        client = RecordingClient(args.upload_latency, args.upload_mb * 1024 * 1024)
+        callback = NullCallback(user_id, 'q_720p')
+        callback.message = client.message()
+        t = time.perf_counter()
+        await main.quality_cb(client, callback)
+        await asyncio.gather(*main.batch_tasks)
+        elapsed = time.perf_counter() - t
+        uploads = sum(n for call, n in client.calls.items() if call.startswith('reply_') and call != 'reply_text')
+        e2e_line("quality_cb batch", uploads, client.uploaded_bytes, elapsed, client.calls)
+
+    await main.video_pool.shutdown()
+    await main.close_http_session()
+    await runner.cleanup()
+
+
+async def bench_upload(args):
+    """PartUploader MB/s vs worker count against a fake part endpoint"""
+    rate = args.rate_mb * 1024 * 1024
+    calls = 0
+
+    async def send_part(index, total, data, worker):
+        # Round trip plus the part's transfer time on one connection
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(args.rtt + len(data) / rate)
+        if args.fail_every and calls % args.fail_every == 0:
+            raise ConnectionError("fake part failure")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'upload.bin')
+        with open(path, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+
+        baseline = None
+        for workers in args.workers:
+            uploader = main.PartUploader(workers, args.part_kb * 1024, main.UPLOAD_PART_RETRIES)
+            t = time.perf_counter()
+            parts = await uploader.upload(path, send_part)
+            elapsed = time.perf_counter() - t
+            baseline = baseline or elapsed
+            print(f"workers={workers}: {parts} parts {elapsed:.2f}s {args.size_mb / elapsed:.1f} MB/s "
+                  f"({baseline / elapsed:.2f}x) retries={uploader.stats['retries']}")
+
+
+async def timed(label: str, coro):
+    t = time.perf_counter()
+    result = await coro
+    print(f"{label}: {time.perf_counter() - t:.2f}s")
+    return result
+
+
+async def bench_media(args):
+    """Post-download analysis cost on a large sample: old probe + thumbnail vs analyze_video"""
+    if not shutil.which('ffmpeg'):
+        print("ffmpeg not found")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DOWNLOAD_DIR = main.Path(tmp)
+        sample = os.path.join(tmp, 'sample.mp4')
+        seconds = args.minutes * 60
+        await timed("generate sample", main.run_media_tool([
+            'ffmpeg', '-v', 'error', '-y',
+            '-f', 'lavfi', '-i', f'testsrc2=duration={seconds}:size=1280x720:rate=30',
+            '-f', 'lavfi', '-i', f'sine=duration={seconds}',
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '60', '-b:v', f'{args.bitrate_mb}M',
+            '-c:a', 'aac', '-movflags', '+faststart', sample
+        ], timeout=3600))
+        print(f"sample: {os.path.getsize(sample) / (1024 * 1024):.0f}MB, {args.minutes} min")
+
+        # Before: ffprobe, then a thumbnail that decodes from the start to the seek point
+        thumb = os.path.join(tmp, 'old.jpg')
+        t = time.perf_counter()
+        await main.get_video_info(sample)
+        await main.run_media_tool(['ffmpeg', '-i', sample, '-ss', '00:00:02', '-vframes', '1',
+                                   '-vf', 'scale=320:180', '-q:v', '2', thumb, '-y'], timeout=300)
+        print(f"old probe + thumbnail: {time.perf_counter() - t:.2f}s")
+
+        for label, info in (("analyze_video, ffprobe needed", {}),
+                            ("analyze_video, yt-dlp info", {'duration': seconds, 'width': 1280, 'height': 720})):
+            job = {'idx': 1, 'path': sample, 'info': info}
+            await timed(label, main.analyze_video(job, 0))
+
+        # Output seeking decodes everything before the seek point, input seeking jumps to a keyframe
+        deep = seconds * 0.9
+        await timed(f"thumbnail at {deep:.0f}s, output seek", main.run_media_tool([
+            'ffmpeg', '-i', sample, '-ss', f'{deep:.3f}', '-vframes', '1',
+            '-vf', 'scale=320:180', '-q:v', '2', thumb, '-y'], timeout=3600))
+        await timed(f"thumbnail at {deep:.0f}s, input seek",
+                    main.generate_thumbnail(sample, thumb, deep))
+
+
+def scale_worker(worker_id: str, journal_path: str, workdir: str, latency: float, rate: float,
+                 ready, stop, results):
+    """One ROLE=worker process against the shared journal, uploads paced on its own link"""
+    async def run():
+        os.makedirs(workdir)
+        main.WORKER_ID = worker_id
+        main.journal = main.JobJournal(main.Path(journal_path))
+        main.app = client = RecordingClient(latency, rate, shared_link=True)
+        main.DOWNLOAD_DIR = main.Path(workdir)
+        main.disk_budget = main.DiskBudget(main.Path(workdir), 0)
+        main.media_cache = main.MediaCache(main.Path(workdir) / 'cache.db')
+        main.host_tuner = main.HostTuner(main.Path(workdir) / 'tuning.db')
+        main.video_pool.start()
+        worker = asyncio.create_task(main.worker_loop())
+        ready.put(worker_id)
+        while not stop.is_set():
+            await asyncio.sleep(0.1)
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+        await main.video_pool.shutdown()
+        await main.close_http_session()
+        results.put((worker_id, dict(client.calls), client.uploaded_bytes, peak_rss_mb()))
+
+    asyncio.run(run())
+
+
+async def bench_scale(args):
+    """Batch throughput vs ROLE=worker process count sharing one journal"""
+    runner, base = await start_site(e2e_origin(args))
+    ctx = multiprocessing.get_context('spawn')
+    loop = asyncio.get_running_loop()
+    baseline = None
+
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as tmp:
+            journal_path = os.path.join(tmp, 'journal.db')
+            journal = main.JobJournal(main.Path(journal_path))
+            ready, results, stop = ctx.Queue(), ctx.Queue(), ctx.Event()
+            procs = [
+                ctx.Process(target=scale_worker, args=(
+                    f'w{n}', journal_path, os.path.join(tmp, f'w{n}'),
+                    args.upload_latency, args.upload_mb * 1024 * 1024, ready, stop, results))
+                for n in range(workers)
+            ]
+            for proc in procs:
+                proc.start()
+            # Interpreter start-up is not batch time
+            for _ in procs:
+                await loop.run_in_executor(None, ready.get)
+
+            t = time.perf_counter()
+            for b in range(args.batches):
+                tag = f'n={workers}&b={b}'
+                items = (
+                    [main.make_item(f'Video {i}', f'{base}/hls/master.m3u8?{tag}&i={i}') for i in range(args.videos)]
+                    + [main.make_item(f'Doc {i}', f'{base}/direct/doc.pdf?{tag}&i={i}') for i in range(args.docs)]
+                    + [main.make_item(f'Image {i}', f'{base}/small/image.jpg?{tag}&i={i}') for i in range(args.images)]
+                )
+                journal.start(b + 1, b + 1, items, 1, len(items), '720p')
+            while True:
+                summary = journal.summary()
+                if not summary['queued'] and not summary['running']:
+                    break
+                await asyncio.sleep(0.05)
+            elapsed = time.perf_counter() - t
+
+            stop.set()
+            calls, nbytes, rss = Counter(), 0, []
+            for _ in procs:
+                _, worker_calls, worker_bytes, worker_rss = await loop.run_in_executor(None, results.get)
+                calls.update(worker_calls)
+                nbytes += worker_bytes
+                rss.append(worker_rss)
+            for proc in procs:
+                proc.join()
+
+            uploads = sum(n for call, n in calls.items() if call.startswith('reply_') and call != 'reply_text')
+            baseline = baseline or args.batches / elapsed
+            print(f"workers={workers}: {args.batches} batches {uploads} items {elapsed:.2f}s "
+                  f"{args.batches / elapsed:.2f} batches/s {uploads / elapsed:.2f} items/s "
+                  f"{nbytes / (1024 * 1024) / elapsed:.1f} MB/s ({args.batches / elapsed / baseline:.2f}x) "
+                  f"peak RSS/worker {max(rss):.0f}MB")
+
+    await main.close_http_session()
+    await runner.cleanup()
+
+
+def write_link_files(tmp: str, lines: int, html_mb: int) -> tuple:
+    exts = ['m3u8', 'mp4', 'pdf', 'jpg', 'html', 'docx', 'ts']
+    txt = os.path.join(tmp, 'links.txt')
+    with open(txt, 'w') as f:
+        for i in range(lines):
+            f.write(f"Lecture {i}: Part {i % 7}: https://cdn{i % 5}.example.com/posts/{i}/file.{exts[i % 7]}?t={i}\n")
+
+    html = os.path.join(tmp, 'links.html')
+    row = '<tr><td>Lecture {0}</td><td><a href="https://cdn.example.com/v/{0}/index.m3u8?a=1&amp;b=2">Lecture {0}</a></td></tr>\n'
+    with open(html, 'w') as f:
+        f.write('<html><body><table>\n')
+        i = 0
+        while f.tell() < html_mb * 1024 * 1024:
+            f.write(row.format(i))
+            i += 1
+        f.write('</table></body></html>\n')
+    return txt, html
+
+
+async def measure_parse(label: str, factory):
+    t = time.perf_counter()
+    count = await factory()
+    elapsed = time.perf_counter() - t
+
+    # Separate pass, tracemalloc slows parsing down several times
+    tracemalloc.start()
+    await factory()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label}: {count} items {elapsed:.2f}s peak={peak / (1024 * 1024):.1f}MB")
+
+
+async def bench_parse(args):
+    """Streaming link parser time and peak memory on large TXT/HTML inputs"""
+    with tempfile.TemporaryDirectory() as tmp:
+        txt, html = write_link_files(tmp, args.lines, args.html_mb)
+        for path in (txt, html):
+            name = os.path.basename(path)
+            size_mb = os.path.getsize(path) / (1024 * 1024)
+
+            async def stream_count():
+                n = 0
+                async for _ in main.iter_links(path):
+                    n += 1
+                return n
+
+            async def stream_collect():
+                return len([item async for item in main.iter_links(path)])
+
+            await measure_parse(f"{name} ({size_mb:.0f}MB) stream, count only", stream_count)
+            await measure_parse(f"{name} ({size_mb:.0f}MB) stream, collected", stream_collect)
+
+        async def read_all():
+            with open(txt, encoding='utf-8') as f:
+                return len(main.parse_content(f.read()))
+
+        await measure_parse("links.txt read whole file + parse_content", read_all)
+
+
+async def bench_cancel(args):
+    """Stop-to-release latency: batch task done, temp files gone, slots free"""
+    app, _ = throttled_origin(args.size_mb * 1024 * 1024, args.rate_mb * 1024 * 1024)
+    runner, base = await start_site(app)
+    user_id = 1
+    path = 'video.mp4' if args.kind == 'video' else 'doc.pdf'
+    main.MEMORY_THRESHOLD = 0
+
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DOWNLOAD_DIR = main.Path(tmp)
+        samples = []
+        for run in range(args.runs):
+            items = [main.make_item(f'Item {i}', f'{base}/{path}?run={run}&i={i}') for i in range(args.items)]
+            links = os.path.join(tmp, 'links.txt')
+            open(links, 'w').close()
+            main.user_data[user_id] = {'items': items, 'file_path': links, 'range': (1, len(items))}
+
+            await main.quality_cb(None, NullCallback(user_id, 'q_720p'))
+            batch = asyncio.gather(*main.batch_tasks)
+            await asyncio.sleep(args.after)
+            in_flight = len(os.listdir(tmp))
+            t = time.perf_counter()
+            main.request_stop(user_id)
+            await batch
+            released = time.perf_counter() - t
+            while os.listdir(tmp) and time.perf_counter() - t < 30:
+                await asyncio.sleep(0.01)
+            cleaned = time.perf_counter() - t
+            left = os.listdir(tmp)
+            busy = main.video_scheduler.active + main.file_scheduler.active
+            samples.append(cleaned * 1000)
+            print(f"run {run}: {in_flight} files in flight, batch released {released * 1000:.0f}ms, "
+                  f"disk clean {cleaned * 1000:.0f}ms, left={left} busy slots={busy}")
+        report(f'{args.kind} stop -> clean', samples)
+
+    await main.close_http_session()
+    await runner.cleanup()
+
+
+SCENARIOS = {
+    'health': bench_health,
+    'hls': bench_hls,
+    'segmented': bench_segmented,
+    'parse': bench_parse,
+    'cancel': bench_cancel,
+    'tuning': bench_tuning,
+    'workers': bench_workers,
+    'e2e': bench_e2e,
+    'upload': bench_upload,
+    'media': bench_media,
+    'scale': bench_scale,
+}
+
+
+def cli():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='scenario', required=True)
+
+    p = sub.add_parser('health', help=bench_health.__doc__)
+    p.add_argument('--jobs', type=int, default=8)
+    p.add_argument('--seconds', type=float, default=3.0)
+
+    p = sub.add_parser('hls', help=bench_hls.__doc__)
+    p.add_argument('--segments', type=int, default=200)
+    p.add_argument('--seg-kb', type=int, default=512)
+    p.add_argument('--latency', type=float, default=0.05, help='per-segment origin delay (s)')
+    p.add_argument('--encrypt', action='store_true')
+
+    p = sub.add_parser('segmented', help=bench_segmented.__doc__)
+    p.add_argument('--size-mb', type=int, default=64)
+    p.add_argument('--rate-mb', type=float, default=4.0, help='per-connection cap (MB/s)')
+    p.add_argument('--connections', type=int, nargs='+', default=[1, 2, 4, 8])
+
+    p = sub.add_parser('parse', help=bench_parse.__doc__)
+    p.add_argument('--lines', type=int, default=100000)
+    p.add_argument('--html-mb', type=int, default=50)
+
+    p = sub.add_parser('cancel', help=bench_cancel.__doc__)
+    p.add_argument('--kind', choices=['file', 'video'], default='file')
+    p.add_argument('--items', type=int, default=3)
+    p.add_argument('--runs', type=int, default=5)
+    p.add_argument('--after', type=float, default=1.0, help='seconds before Stop')
+    p.add_argument('--size-mb', type=int, default=64)
+    p.add_argument('--rate-mb', type=float, default=2.0, help='per-connection cap (MB/s)')
+
+    p = sub.add_parser('tuning', help=bench_tuning.__doc__)
+    p.add_argument('--jobs', type=int, default=10)
+    p.add_argument('--segments', type=int, default=120)
+    p.add_argument('--seg-kb', type=int, default=256)
+    p.add_argument('--latency', type=float, default=0.1, help='per-segment origin delay (s)')
+    p.add_argument('--limit', type=int, default=10, help='parallel segment requests before 429')
+
+    p = sub.add_parser('workers', help=bench_workers.__doc__)
+    p.add_argument('--videos', type=int, default=4)
+    p.add_argument('--segments', type=int, default=300)
+    p.add_argument('--seg-kb', type=int, default=256)
+    p.add_argument('--encrypt', action='store_true')
+
+    p = sub.add_parser('e2e', help=bench_e2e.__doc__)
+    p.add_argument('--videos', type=int, default=4)
+    p.add_argument('--docs', type=int, default=8)
+    p.add_argument('--images', type=int, default=8)
+    p.add_argument('--file-mb', type=int, default=32)
+    p.add_argument('--image-kb', type=int, default=512)
+    p.add_argument('--rate-mb', type=float, default=4.0, help='throttled origin per-connection cap (MB/s)')
+    p.add_argument('--segments', type=int, default=60)
+    p.add_argument('--seg-kb', type=int, default=256)
+    p.add_argument('--latency', type=float, default=0.02, help='per-segment origin delay (s)')
+    p.add_argument('--upload-latency', type=float, default=0.2, help='fixed cost per upload (s)')
+    p.add_argument('--upload-mb', type=float, default=20.0, help='fake upload bandwidth (MB/s)')
+
+    p = sub.add_parser('upload', help=bench_upload.__doc__)
+    p.add_argument('--size-mb', type=int, default=256)
+    p.add_argument('--part-kb', type=int, default=512)
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    p.add_argument('--rtt', type=float, default=0.05, help='per-part round trip (s)')
+    p.add_argument('--rate-mb', type=float, default=4.0, help='per-connection bandwidth (MB/s)')
+    p.add_argument('--fail-every', type=int, default=0, help='fail every Nth part call')
+
+    p = sub.add_parser('media', help=bench_media.__doc__)
+    p.add_argument('--minutes', type=int, default=30)
+    p.add_argument('--bitrate-mb', type=int, default=4, help='sample video bitrate (Mbit/s)')
+
+    p = sub.add_parser('scale', help=bench_scale.__doc__)
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    p.add_argument('--batches', type=int, default=8)
+    p.add_argument('--videos', type=int, default=1, help='per batch')
+    p.add_argument('--docs', type=int, default=3, help='per batch')
+    p.add_argument('--images', type=int, default=2, help='per batch')
+    p.add_argument('--file-mb', type=int, default=8)
+    p.add_argument('--image-kb', type=int, default=512)
+    p.add_argument('--rate-mb', type=float, default=4.0, help='throttled origin per-connection cap (MB/s)')
+    p.add_argument('--segments', type=int, default=40)
+    p.add_argument('--seg-kb', type=int, default=256)
+    p.add_argument('--latency', type=float, default=0.02, help='per-segment origin delay (s)')
+    p.add_argument('--upload-latency', type=float, default=0.2, help='fixed cost per upload (s)')
+    p.add_argument('--upload-mb', type=float, default=10.0, help='upload bandwidth per worker (MB/s)')
+
+    args = parser.parse_args()
+    asyncio.run(SCENARIOS[args.scenario](args))
+
+
+if __name__ == '__main__':
+    cli()
@@ -1,16 +1,37 @@
+import html
+import io
 import os
 import re
 import asyncio
 import aiohttp
 import aiofiles
+import shutil
 import ssl
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from pyrogram import Client, filters, idle
+from urllib.parse import urljoin, urlparse, urlsplit, urlunsplit, urlencode, parse_qsl, unquote
+from pyrogram import Client, filters, idle, raw
+from pyrogram.errors import FloodWait, MessageNotModified
+from pyrogram.session import Session
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 import yt_dlp
-from typing import Dict, Optional
+from yt_dlp.aes import aes_cbc_decrypt_bytes, unpad_pkcs7
+from typing import Dict, Optional, Tuple, Union
 import logging
-import subprocess
+import bisect
+import inspect
+import itertools
+import json
+import multiprocessing
+import signal
+import socket
+import sqlite3
+import threading
+import time
 import mimetypes
 
 logging.basicConfig(
@@ -24,184 +45,2059 @@ API_HASH = os.getenv("API_HASH", "")
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 PORT = int(os.getenv("PORT", "10000"))
 
-app = Client("m3u8_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+# Parallel upload engine: big files go out as parts over several media sessions
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "8"))
+UPLOAD_SESSIONS = max(1, min(UPLOAD_WORKERS, int(os.getenv("UPLOAD_SESSIONS", "4"))))
+UPLOAD_PART_SIZE = int(os.getenv("UPLOAD_PART_KB", "512")) * 1024
+UPLOAD_PART_RETRIES = int(os.getenv("UPLOAD_PART_RETRIES", "5"))
+# Telegram takes SaveBigFilePart above 10MB only
+UPLOAD_PARALLEL_MIN = 10 * 1024 * 1024
+# Largest file Telegram accepts, and the most parts it takes for one file
+UPLOAD_LIMIT = int(os.getenv("UPLOAD_LIMIT_MB", "2000")) * 1024 * 1024
+UPLOAD_MAX_PARTS = 4000
+
+if UPLOAD_PART_SIZE <= 0 or UPLOAD_PART_SIZE % 1024 or (512 * 1024) % UPLOAD_PART_SIZE:
+    logger.warning("UPLOAD_PART_KB must divide 512, using 512")
+    UPLOAD_PART_SIZE = 512 * 1024
+elif UPLOAD_PART_SIZE * UPLOAD_MAX_PARTS < UPLOAD_LIMIT:
+    logger.warning(f"UPLOAD_PART_KB={UPLOAD_PART_SIZE // 1024} needs over {UPLOAD_MAX_PARTS} parts "
+                   f"for a {UPLOAD_LIMIT // (1024 * 1024)}MB file, using 512")
+    UPLOAD_PART_SIZE = 512 * 1024
+
+
+class PartUploader:
+    """Sends a file in parts from several workers, each part retried on its own
+
+    send_part(index, total, data, worker) does the transfer, so the engine
+    runs the same against Telegram sessions or a benchmark stand-in.
+    """
+    
+    def __init__(self, workers: int, part_size: int, retries: int):
+        self.workers = workers
+        self.part_size = part_size
+        self.retries = retries
+        self.stats = {'files': 0, 'parts': 0, 'retries': 0}
+    
+    async def upload(self, path: str, send_part, progress=None) -> int:
+        """Upload path, returns the number of parts"""
+        size = os.path.getsize(path)
+        total = -(-size // self.part_size)
+        parts = iter(range(total))
+        sent = 0
+        loop = asyncio.get_event_loop()
+        fd = os.open(path, os.O_RDONLY)
+        
+        async def worker(n: int):
+            nonlocal sent
+            # Workers share one iterator, so every part is taken exactly once
+            for index in parts:
+                data = await loop.run_in_executor(None, os.pread, fd, self.part_size, index * self.part_size)
+                for attempt in range(self.retries):
+                    try:
+                        await send_part(index, total, data, n)
+                        break
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        if attempt == self.retries - 1:
+                            raise
+                        self.stats['retries'] += 1
+                        delay = e.value if isinstance(e, FloodWait) else min(30, 2 ** attempt)
+                        logger.warning(f"Upload part {index}/{total} failed: {e}, retry in {delay}s")
+                        await asyncio.sleep(delay)
+                self.stats['parts'] += 1
+                sent += len(data)
+                if progress:
+                    await progress(sent, size)
+        
+        tasks = [asyncio.create_task(worker(n)) for n in range(min(self.workers, total))]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            os.close(fd)
+        self.stats['files'] += 1
+        return total
+
+
+part_uploader = PartUploader(UPLOAD_WORKERS, UPLOAD_PART_SIZE, UPLOAD_PART_RETRIES)
+
+
+class UploadClient(Client):
+    """Client whose big file uploads go through part_uploader
+
+    reply_video/reply_document call save_file, so every upload path picks
+    this up. Media sessions stay open between files instead of being set up
+    per upload.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.upload_sessions: list = []
+        self.upload_sessions_lock: Optional[asyncio.Lock] = None
+    
+    async def get_upload_sessions(self) -> list:
+        self.upload_sessions_lock = self.upload_sessions_lock or asyncio.Lock()
+        async with self.upload_sessions_lock:
+            if not self.upload_sessions:
+                dc_id = await self.storage.dc_id()
+                auth_key = await self.storage.auth_key()
+                test_mode = await self.storage.test_mode()
+                for _ in range(UPLOAD_SESSIONS):
+                    session = Session(self, dc_id, auth_key, test_mode, is_media=True)
+                    await session.start()
+                    self.upload_sessions.append(session)
+        return self.upload_sessions
+    
+    async def save_file(self, path, file_id: int = None, file_part: int = 0,
+                        progress=None, progress_args: tuple = ()):
+        if (not isinstance(path, str) or file_id is not None
+                or os.path.getsize(path) <= UPLOAD_PARALLEL_MIN):
+            return await super().save_file(path, file_id, file_part, progress, progress_args)
+        
+        sessions = await self.get_upload_sessions()
+        file_id = self.rnd_id()
+        
+        async def send_part(index: int, total: int, data: bytes, worker: int):
+            await sessions[worker % len(sessions)].invoke(raw.functions.upload.SaveBigFilePart(
+                file_id=file_id, file_part=index, file_total_parts=total, bytes=data
+            ))
+        
+        async def report(current: int, total: int):
+            if inspect.iscoroutinefunction(progress):
+                await progress(current, total, *progress_args)
+            else:
+                progress(current, total, *progress_args)
+        
+        parts = await part_uploader.upload(path, send_part, report if progress else None)
+        return raw.types.InputFileBig(id=file_id, parts=parts, name=os.path.basename(path))
+    
+    async def stop(self, block: bool = True):
+        for session in self.upload_sessions:
+            try:
+                await session.stop()
+            except Exception as e:
+                logger.warning(f"Upload session stop failed: {e}")
+        self.upload_sessions = []
+        return await super().stop(block)
+
+
+# Deployment role: "all" runs everything in one process, "bot" only parses files
+# and queues batches in the journal, "worker" claims queued batches and runs them.
+# Workers may run on other nodes as long as they share the journal file.
+ROLE = os.getenv("ROLE", "all")
+WORKER_ID = os.getenv("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+
+if ROLE == "worker":
+    # Same bot, own session; the bot process alone receives updates
+    app = UploadClient(f"m3u8_worker_{WORKER_ID}", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN,
+                       in_memory=True, no_updates=True)
+else:
+    app = UploadClient("m3u8_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
 user_data: Dict[int, dict] = {}
 active_downloads: Dict[int, bool] = {}
 download_progress: Dict[int, dict] = {}
+cancel_tokens: Dict[int, "CancelToken"] = {}
+batch_tasks: set = set()
+active_workdirs: set = set()
+
+DOWNLOAD_DIR = Path(os.getenv("DOWNLOAD_DIR", "downloads"))
+if ROLE == "worker":
+    # Own scratch root, so workers sharing downloads/ never touch each other's
+    # files. A stable WORKER_ID lets a restarted worker find its partials.
+    DOWNLOAD_DIR = DOWNLOAD_DIR / f"worker_{WORKER_ID}"
+
+# How many downloaded items may wait between pipeline stages
+PREFETCH_DEPTH = max(1, int(os.getenv("PREFETCH_DEPTH", "2")))
+
+QUALITY_MAP = {
+    "360p": "360",
+    "480p": "480", 
+    "720p": "720",
+    "1080p": "1080",
+}
+
+# ffmpeg/ffprobe processes allowed to run at once
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", str(os.cpu_count() or 2)))
+media_semaphore = asyncio.Semaphore(MEDIA_WORKERS)
+
+# Persistent URL -> Telegram file_id cache
+DATA_DIR = Path(os.getenv("DATA_DIR", "data"))
+
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "50000"))
+CACHE_MAX_AGE_DAYS = int(os.getenv("CACHE_MAX_AGE_DAYS", "60"))
+
+cache_stats = {'hits': 0, 'misses': 0}
+
+
+def normalize_url(url: str) -> str:
+    """Canonical form: lowercase scheme/host, default port, fragment and query order dropped"""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and (scheme, parts.port) not in (('http', 80), ('https', 443)):
+        host = f"{host}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+
+def cache_key(item: dict, quality: str) -> str:
+    # Images and documents look the same at every quality
+    variant = quality if item['type'] == 'video' else ''
+    return f"{item['type']}|{variant}|{normalize_url(item['url'])}"
+
+
+class MediaCache:
+    """SQLite store of uploaded file_ids, evicted by age and entry count"""
+    
+    def __init__(self, path: Path):
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+    
+    @property
+    def db(self) -> sqlite3.Connection:
+        # Opened on first use, importing the module (video workers do) touches no files
+        if self.conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(str(self.path))
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS media_cache ("
+                "key TEXT PRIMARY KEY, kind TEXT, file_id TEXT, meta TEXT, "
+                "created REAL, last_used REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS media_cache_used ON media_cache(last_used)")
+            self.conn.commit()
+            self.evict()
+        return self.conn
+    
+    def get(self, key: str) -> Optional[dict]:
+        row = self.db.execute(
+            "SELECT kind, file_id, meta FROM media_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE media_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.db.commit()
+        return {'kind': row[0], 'file_id': row[1], 'meta': json.loads(row[2])}
+    
+    def put(self, key: str, kind: str, file_id: str, meta: dict):
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO media_cache VALUES (?, ?, ?, ?, ?, ?)",
+            (key, kind, file_id, json.dumps(meta), now, now)
+        )
+        self.db.commit()
+    
+    def delete(self, key: str):
+        self.db.execute("DELETE FROM media_cache WHERE key = ?", (key,))
+        self.db.commit()
+    
+    def evict(self):
+        cutoff = time.time() - CACHE_MAX_AGE_DAYS * 86400
+        self.db.execute("DELETE FROM media_cache WHERE last_used < ?", (cutoff,))
+        self.db.execute(
+            "DELETE FROM media_cache WHERE key IN ("
+            "SELECT key FROM media_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (CACHE_MAX_ENTRIES,)
+        )
+        self.db.commit()
+    
+    def size(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM media_cache").fetchone()[0]
+
+
+media_cache = MediaCache(DATA_DIR / "media_cache.db")
+
+
+class JobJournal:
+    """Running batches and per-item outcomes in SQLite (WAL), survives restarts
+
+    A batch row lives from the quality choice until the summary is sent, so
+    rows found at startup belong to batches a restart interrupted. With
+    ROLE=bot/worker it is also the job queue: workers claim rows under a
+    lease they keep alive with heartbeat(), a row whose lease ran out goes
+    to the next worker that asks.
+    """
+    
+    def __init__(self, path: Path):
+        self.path = path
+        # One connection per thread, workers call in from asyncio.to_thread
+        self.local = threading.local()
+        self.setup_lock = threading.Lock()
+        self.ready = False
+    
+    def setup(self, db: sqlite3.Connection):
+        """Create the tables, once per process on the first connection"""
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS batches ("
+            "user_id INTEGER PRIMARY KEY, chat_id INTEGER, items TEXT, "
+            "start INTEGER, end INTEGER, quality TEXT, created REAL, "
+            "worker TEXT, heartbeat REAL, stop INTEGER DEFAULT 0)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS batch_items ("
+            "user_id INTEGER, idx INTEGER, status TEXT, updated REAL, "
+            "PRIMARY KEY (user_id, idx))"
+        )
+        # Journals from before the queue columns existed
+        for column in ("worker TEXT", "heartbeat REAL", "stop INTEGER DEFAULT 0"):
+            try:
+                db.execute(f"ALTER TABLE batches ADD COLUMN {column}")
+            except sqlite3.OperationalError:
+                pass
+        db.commit()
+    
+    @property
+    def db(self) -> sqlite3.Connection:
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(self.path), timeout=30)
+            db.execute(f"PRAGMA journal_mode={JOURNAL_MODE}")
+            db.execute("PRAGMA synchronous=NORMAL")
+            with self.setup_lock:
+                if not self.ready:
+                    self.setup(db)
+                    self.ready = True
+            self.local.db = db
+        return db
+    
+    def start(self, user_id: int, chat_id: int, items: list, start: int, end: int, quality: str) -> float:
+        """Record a new batch, returns its creation time which also names its scratch directory"""
+        created = time.time()
+        self.db.execute("DELETE FROM batch_items WHERE user_id = ?", (user_id,))
+        self.db.execute(
+            "INSERT OR REPLACE INTO batches (user_id, chat_id, items, start, end, quality, created) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, chat_id, json.dumps(items), start, end, quality, created)
+        )
+        self.db.commit()
+        return created
+    
+    def active(self, user_id: int) -> bool:
+        return self.db.execute("SELECT 1 FROM batches WHERE user_id = ?", (user_id,)).fetchone() is not None
+    
+    def claim(self, worker: str, lease: float) -> Optional[dict]:
+        """Take the oldest queued or abandoned batch for worker, None if there is none"""
+        now = time.time()
+        # Plain read first, the write lock is only worth taking with work to do
+        if not self.db.execute(
+            "SELECT 1 FROM batches WHERE worker IS NULL OR heartbeat < ? LIMIT 1", (now - lease,)
+        ).fetchone():
+            return None
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            # Stopped while nobody was running them
+            self.db.execute(
+                "DELETE FROM batch_items WHERE user_id IN (SELECT user_id FROM batches "
+                "WHERE stop = 1 AND (worker IS NULL OR heartbeat < ?))", (now - lease,)
+            )
+            self.db.execute("DELETE FROM batches WHERE stop = 1 AND (worker IS NULL OR heartbeat < ?)", (now - lease,))
+            row = self.db.execute(
+                "SELECT user_id, chat_id, items, start, end, quality, created FROM batches "
+                "WHERE worker IS NULL OR heartbeat < ? ORDER BY created LIMIT 1", (now - lease,)
+            ).fetchone()
+            if row:
+                self.db.execute("UPDATE batches SET worker = ?, heartbeat = ? WHERE user_id = ?",
+                                (worker, now, row[0]))
+            self.db.commit()
+        except BaseException:
+            self.db.rollback()
+            raise
+        return self._batch(row) if row else None
+    
+    def heartbeat(self, worker: str, user_ids: list) -> Dict[int, bool]:
+        """Renew worker's leases on batches it is running, returns {user_id: stop requested}
+
+        Rows the worker holds but no longer runs, say after a pipeline error,
+        are left to expire so another worker picks them up.
+        """
+        if not user_ids:
+            return {}
+        marks = ','.join('?' * len(user_ids))
+        self.db.execute(f"UPDATE batches SET heartbeat = ? WHERE worker = ? AND user_id IN ({marks})",
+                        (time.time(), worker, *user_ids))
+        self.db.commit()
+        rows = self.db.execute(f"SELECT user_id, stop FROM batches WHERE worker = ? AND user_id IN ({marks})",
+                               (worker, *user_ids))
+        return {user_id: bool(stop) for user_id, stop in rows}
+    
+    def release(self, worker: str):
+        """Hand worker's batches back to the queue right away, on a clean shutdown"""
+        self.db.execute("UPDATE batches SET worker = NULL, heartbeat = NULL WHERE worker = ?", (worker,))
+        self.db.commit()
+    
+    def request_stop(self, user_id: int) -> bool:
+        cur = self.db.execute("UPDATE batches SET stop = 1 WHERE user_id = ?", (user_id,))
+        self.db.commit()
+        return cur.rowcount > 0
+    
+    def mark(self, user_id: int, idx: int, status: str):
+        """Record a delivered item: 'success', 'cached' or 'failed'"""
+        self.db.execute(
+            "INSERT OR REPLACE INTO batch_items VALUES (?, ?, ?, ?)",
+            (user_id, idx, status, time.time())
+        )
+        self.db.commit()
+    
+    def finish(self, user_id: int, worker: Optional[str] = None) -> bool:
+        """Drop a finished batch, only if worker still holds it when given"""
+        if worker is None:
+            cur = self.db.execute("DELETE FROM batches WHERE user_id = ?", (user_id,))
+        else:
+            cur = self.db.execute("DELETE FROM batches WHERE user_id = ? AND worker = ?", (user_id, worker))
+        if cur.rowcount:
+            self.db.execute("DELETE FROM batch_items WHERE user_id = ?", (user_id,))
+        self.db.commit()
+        return cur.rowcount > 0
+    
+    def counts(self, user_id: int) -> dict:
+        rows = self.db.execute(
+            "SELECT status, COUNT(*) FROM batch_items WHERE user_id = ? GROUP BY status", (user_id,)
+        ).fetchall()
+        done = dict(rows)
+        return {
+            'success': done.get('success', 0) + done.get('cached', 0),
+            'failed': done.get('failed', 0),
+            'cached': done.get('cached', 0),
+        }
+    
+    def done(self, user_id: int) -> set:
+        """Indices of the batch's items that already have an outcome"""
+        return {idx for (idx,) in self.db.execute(
+            "SELECT idx FROM batch_items WHERE user_id = ?", (user_id,)
+        )}
+    
+    def _batch(self, row: tuple) -> dict:
+        user_id, chat_id, items, start, end, quality, created = row
+        done = self.done(user_id)
+        # Everything after the first gap is still to do, except items that
+        # were delivered out of order; fetch_stage skips those by done()
+        first = next((i for i in range(start, end + 1) if i not in done), end + 1)
+        return {
+            'user_id': user_id, 'chat_id': chat_id, 'items': json.loads(items),
+            'start': start, 'end': end, 'quality': quality, 'first': first,
+            'created': created,
+        }
+    
+    def unfinished(self) -> list:
+        rows = self.db.execute(
+            "SELECT user_id, chat_id, items, start, end, quality, created FROM batches"
+        ).fetchall()
+        return [self._batch(row) for row in rows]
+    
+    def summary(self) -> dict:
+        """Queued batches and running ones per worker"""
+        rows = self.db.execute("SELECT COALESCE(worker, ''), COUNT(*) FROM batches GROUP BY worker").fetchall()
+        running = {worker: n for worker, n in rows if worker}
+        return {'queued': sum(n for worker, n in rows if not worker), 'running': running}
+
+
+# Shared with the workers when they run elsewhere. WAL needs every process on one
+# host, JOURNAL_MODE=DELETE for a journal on a network filesystem.
+JOURNAL_PATH = Path(os.getenv("JOURNAL_PATH", str(DATA_DIR / "journal.db")))
+JOURNAL_MODE = os.getenv("JOURNAL_MODE", "WAL")
+# A worker that misses heartbeats this long loses its batches to another worker
+WORKER_LEASE = float(os.getenv("WORKER_LEASE", "60"))
+WORKER_HEARTBEAT = 5.0
+WORKER_BATCHES = int(os.getenv("WORKER_BATCHES", "2"))
+WORKER_POLL = 1.0
+# Workers serve /health and /metrics only on a port of their own, so several
+# can share a host; unset means no web server
+WORKER_PORT = int(os.getenv("WORKER_PORT", "0"))
+
+JOURNAL_RETRIES = 3
+
+journal = JobJournal(JOURNAL_PATH)
+
+
+async def journal_call(method, *args):
+    """Run a journal method off the event loop, retrying while another process holds the lock"""
+    for attempt in range(JOURNAL_RETRIES):
+        try:
+            return await asyncio.to_thread(method, *args)
+        except sqlite3.OperationalError as e:
+            busy = 'locked' in str(e) or 'busy' in str(e)
+            if not busy or attempt == JOURNAL_RETRIES - 1:
+                raise
+            logger.warning(f"Journal busy ({e}), retry {attempt + 1}")
+            await asyncio.sleep(2 ** attempt)
+
+
+def sent_media(msg: Message) -> Tuple[Optional[str], Optional[str]]:
+    """(kind, file_id) of the media Telegram stored for a sent message"""
+    for kind in ('video', 'animation', 'photo', 'document'):
+        media = getattr(msg, kind, None)
+        if media:
+            return kind, media.file_id
+    return None, None
+
+# Supported file types
+SUPPORTED_TYPES = {
+    'video': ['.m3u8', '.mpd', '.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv', '.webm', '.ts'],
+    'image': ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp', '.svg'],
+    'document': ['.pdf', '.doc', '.docx', '.txt', '.zip', '.rar']
+}
+
+# Prometheus text-format metrics. Recording is a dict update, so it stays on
+METRICS_PREFIX = "uploader_"
+STAGE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+LOOP_LAG_INTERVAL = 1.0
+
+METRIC_HELP = {
+    'stage_seconds': ('histogram', "Duration of completed pipeline stages by item type"),
+    'downloaded_bytes_total': ('counter', "Bytes downloaded by item type"),
+    'uploaded_bytes_total': ('counter', "Bytes uploaded to Telegram by item type"),
+    'items_total': ('counter', "Finished batch items by type, result and reason"),
+    'active_batches': ('gauge', "Batches currently running"),
+    'scheduler_active': ('gauge', "Scheduler slots in use"),
+    'scheduler_queued': ('gauge', "Jobs waiting for a scheduler slot"),
+    'executor_tasks': ('gauge', "Tasks in flight in worker pools"),
+    'event_loop_lag_seconds': ('gauge', "How late the event loop ran a periodic timer"),
+}
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Metrics:
+    """Counters and stage histograms, gauges are read at scrape time"""
+    
+    def __init__(self):
+        self.counters: Dict[tuple, float] = {}
+        # (name, labels) -> per-bucket counts incl. +Inf, then sum and count
+        self.histograms: Dict[tuple, list] = {}
+        self.media_in_flight = 0
+        self.loop_lag = 0.0
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = [0] * (len(STAGE_BUCKETS) + 3)
+        hist[bisect.bisect_left(STAGE_BUCKETS, value)] += 1
+        hist[-2] += value
+        hist[-1] += 1
+    
+    @contextmanager
+    def timer(self, stage: str, kind: str):
+        """Observe the block's duration unless it raises"""
+        start = time.monotonic()
+        yield
+        self.observe('stage_seconds', time.monotonic() - start, stage=stage, type=kind)
+    
+    def gauges(self) -> Dict[str, list]:
+        schedulers = (video_scheduler, file_scheduler, upload_scheduler)
+        return {
+            'active_batches': [((), sum(1 for v in active_downloads.values() if v))],
+            'scheduler_active': [((('scheduler', s.name),), s.active) for s in schedulers],
+            'scheduler_queued': [((('scheduler', s.name),), s.queued()) for s in schedulers],
+            'executor_tasks': [
+                ((('pool', 'video'),), len(video_pool.running)),
+                ((('pool', 'media'),), self.media_in_flight),
+            ],
+            'event_loop_lag_seconds': [((), round(self.loop_lag, 6))],
+        }
+    
+    def render(self) -> str:
+        gauges = self.gauges()
+        lines = []
+        for name, (kind, text) in METRIC_HELP.items():
+            full = METRICS_PREFIX + name
+            lines.append(f"# HELP {full} {text}")
+            lines.append(f"# TYPE {full} {kind}")
+            if kind == 'gauge':
+                for labels, value in gauges[name]:
+                    lines.append(f"{full}{format_labels(labels)} {value}")
+            elif kind == 'counter':
+                for (n, labels), value in self.counters.items():
+                    if n == name:
+                        lines.append(f"{full}{format_labels(labels)} {value}")
+            else:
+                for (n, labels), hist in self.histograms.items():
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(STAGE_BUCKETS + ('+Inf',), hist):
+                        cumulative += count
+                        le = format_labels(labels + (('le', bound),))
+                        lines.append(f"{full}_bucket{le} {cumulative}")
+                    lines.append(f"{full}_sum{format_labels(labels)} {hist[-2]:.3f}")
+                    lines.append(f"{full}_count{format_labels(labels)} {hist[-1]}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+async def watch_loop_lag():
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics.loop_lag = max(0.0, time.monotonic() - start - LOOP_LAG_INTERVAL)
+
+
+def payload_size(source: Union[str, io.BytesIO]) -> int:
+    return source.getbuffer().nbytes if isinstance(source, io.BytesIO) else os.path.getsize(source)
+
+
+# Web server
+from aiohttp import web
+web_app = web.Application()
+
+async def health_check(request):
+    return web.Response(text="OK")
+
+async def readiness_check(request):
+    """200 once the bot is connected and the disk has room, 503 otherwise"""
+    problems = []
+    if not app.is_connected:
+        problems.append("telegram disconnected")
+    if disk_budget.is_low():
+        problems.append(f"disk below {DISK_LOW_WATERMARK // (1024 * 1024)}MB free")
+    if problems:
+        return web.Response(status=503, text="NOT READY: " + ", ".join(problems))
+    return web.Response(text="OK")
+
+async def metrics_handler(request):
+    # Scrapers tell the exposition format by the version parameter of the content type
+    return web.Response(text=metrics.render(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+async def stats_handler(request):
+    return web.json_response({
+        'http': http_stats,
+        'cache': dict(cache_stats, entries=media_cache.size()),
+        'progress_edits': progress_renderer.stats,
+        'disk': disk_budget.usage(),
+        'hosts': host_tuner.summary(),
+        'video_pool': video_pool.stats,
+        'uploads': part_uploader.stats,
+        'host_guard': host_guard.summary(),
+        'batches': journal.summary(),
+        'scheduler': {
+            s.name: {'active': s.active, 'slots': s.slots, 'queued': s.queued()}
+            for s in (video_scheduler, file_scheduler, upload_scheduler)
+        },
+    })
+
+web_app.router.add_get("/", health_check)
+web_app.router.add_get("/health", readiness_check)
+web_app.router.add_get("/stats", stats_handler)
+web_app.router.add_get("/metrics", metrics_handler)
+
+
+# Shared HTTP client, created in main() and closed on shutdown
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_PER_HOST_LIMIT = int(os.getenv("HTTP_PER_HOST_LIMIT", "16"))
+
+http_session: Optional[aiohttp.ClientSession] = None
+http_stats = {'new_connections': 0, 'reused_connections': 0}
+
+
+async def _on_connection_create(session, ctx, params):
+    http_stats['new_connections'] += 1
+
+
+async def _on_connection_reuse(session, ctx, params):
+    http_stats['reused_connections'] += 1
+
+
+def create_http_session() -> aiohttp.ClientSession:
+    """Pooled keep-alive session with DNS cache and per-host limits"""
+    ssl_context = ssl.create_default_context()
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    
+    connector = aiohttp.TCPConnector(
+        ssl=ssl_context,
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_PER_HOST_LIMIT,
+        use_dns_cache=True,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+        enable_cleanup_closed=True,
+    )
+    
+    trace = aiohttp.TraceConfig()
+    trace.on_connection_create_end.append(_on_connection_create)
+    trace.on_connection_reuseconn.append(_on_connection_reuse)
+    
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers={'User-Agent': 'Mozilla/5.0'},
+        trace_configs=[trace],
+    )
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+    return http_session
+
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+        # Give SSL transports a moment to shut down
+        await asyncio.sleep(0.25)
+    http_session = None
+
+
+# Per-host politeness shared by aiohttp and yt-dlp: concurrency cap, token-bucket
+# request rate, Retry-After and a circuit breaker that fails fast on dead hosts
+HOST_MAX_ACTIVE = int(os.getenv("HOST_MAX_ACTIVE", "16"))
+HOST_RATE = float(os.getenv("HOST_RATE", "50"))
+HOST_BURST = int(os.getenv("HOST_BURST", "100"))
+HOST_DEFAULT_BACKOFF = 5.0
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "120"))
+# Move items of a dead host to the end of the batch instead of failing them
+DEFER_DEAD_HOSTS = os.getenv("DEFER_DEAD_HOSTS", "0") == "1"
+YTDLP_RETRIES = 15
+YTDLP_SUSPECT_RETRIES = 3
+
+
+class HostUnavailable(Exception):
+    """Host's circuit is open, the request was not attempted"""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds from a Retry-After header, delta or HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostGuard:
+    """Per-host request pacing and circuit breaker
+
+    After BREAKER_FAILURES consecutive failures (connection errors, timeouts,
+    5xx) a host is open: requests raise HostUnavailable without touching the
+    network. After BREAKER_COOLDOWN one trial request is let through, its
+    outcome closes or reopens the circuit. 4xx answers count as a live host.
+    """
+    
+    def __init__(self):
+        self.hosts: Dict[str, dict] = {}
+    
+    def state(self, host: str) -> dict:
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = {
+                'sem': asyncio.Semaphore(HOST_MAX_ACTIVE), 'tokens': float(HOST_BURST),
+                'stamp': time.monotonic(), 'blocked_until': 0.0,
+                'failures': 0, 'opened': None, 'trial': False,
+            }
+        return state
+    
+    def cooldown_left(self, host: str) -> float:
+        opened = self.state(host)['opened']
+        if opened is None:
+            return 0.0
+        return max(0.0, opened + BREAKER_COOLDOWN - time.monotonic())
+    
+    def _admit(self, host: str) -> bool:
+        """Raise while the circuit is open, returns whether this is the half-open trial"""
+        state = self.state(host)
+        if state['opened'] is None:
+            return False
+        left = self.cooldown_left(host)
+        if left > 0 or state['trial']:
+            raise HostUnavailable(f"{host} is down, next try in {max(left, 1):.0f}s")
+        state['trial'] = True
+        return True
+    
+    async def _pace(self, state: dict):
+        while True:
+            now = time.monotonic()
+            if now < state['blocked_until']:
+                await asyncio.sleep(state['blocked_until'] - now)
+                continue
+            if HOST_RATE <= 0:
+                return
+            state['tokens'] = min(HOST_BURST, state['tokens'] + (now - state['stamp']) * HOST_RATE)
+            state['stamp'] = now
+            if state['tokens'] >= 1:
+                state['tokens'] -= 1
+                return
+            await asyncio.sleep((1 - state['tokens']) / HOST_RATE)
+    
+    @asynccontextmanager
+    async def slot(self, host: str):
+        """Hold one of the host's slots for a request or a yt-dlp job"""
+        state = self.state(host)
+        trial = self._admit(host)
+        try:
+            async with state['sem']:
+                await self._pace(state)
+                yield
+        finally:
+            # A trial that ended without a verdict lets the next one in
+            if trial and state['trial']:
+                state['trial'] = False
+    
+    def success(self, host: str):
+        state = self.state(host)
+        if state['opened'] is not None:
+            logger.info(f"Host {host} is back, closing its circuit")
+        state.update(failures=0, opened=None, trial=False)
+    
+    def failure(self, host: str):
+        state = self.state(host)
+        state['failures'] += 1
+        if state['trial'] or (state['opened'] is None and state['failures'] >= BREAKER_FAILURES):
+            logger.warning(f"Host {host} failed {state['failures']} times, failing fast for {BREAKER_COOLDOWN:.0f}s")
+            state.update(opened=time.monotonic(), trial=False)
+    
+    def backoff(self, host: str, seconds: float):
+        state = self.state(host)
+        state['blocked_until'] = max(state['blocked_until'], time.monotonic() + seconds)
+    
+    def observe(self, host: str, status: int, retry_after: Optional[str] = None):
+        """Feed an HTTP answer into the host's state"""
+        if status == 429 or (status == 503 and retry_after):
+            self.backoff(host, parse_retry_after(retry_after) or HOST_DEFAULT_BACKOFF)
+        elif status >= 500:
+            self.failure(host)
+        else:
+            self.success(host)
+    
+    def retry_budget(self, host: str) -> int:
+        """yt-dlp retries, cut short for a host that has been failing"""
+        return YTDLP_SUSPECT_RETRIES if self.state(host)['failures'] else YTDLP_RETRIES
+    
+    def summary(self) -> dict:
+        return {
+            host: {'failures': s['failures'], 'open_for': round(self.cooldown_left(host))}
+            for host, s in self.hosts.items() if s['failures'] or s['opened'] is not None
+        }
+
+
+host_guard = HostGuard()
+
+
+@asynccontextmanager
+async def host_request(method: str, url: str, **kwargs):
+    """Shared-session request paced by host_guard and feeding its breaker"""
+    host = urlparse(url).hostname or ''
+    async with host_guard.slot(host):
+        try:
+            async with get_http_session().request(method, url, **kwargs) as response:
+                host_guard.observe(host, response.status, response.headers.get('Retry-After'))
+                yield response
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            host_guard.failure(host)
+            raise
+
+
+# Progress rendering: every status edit goes through one rate-limited service
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", "3"))
+CHAT_EDITS_PER_MINUTE = int(os.getenv("CHAT_EDITS_PER_MINUTE", "20"))
+GLOBAL_EDITS_PER_SECOND = int(os.getenv("GLOBAL_EDITS_PER_SECOND", "20"))
+
+
+class ProgressRenderer:
+    """Coalesces status edits per message and sends them within edit budgets
+
+    Callers hand over the latest text; only the newest pending text of a
+    message is sent, at most once per PROGRESS_MIN_INTERVAL, and only when
+    it differs from what is already shown.
+    """
+    
+    def __init__(self):
+        self.pending: Dict[tuple, tuple] = OrderedDict()
+        self.shown: Dict[tuple, str] = {}
+        self.last_edit: Dict[tuple, float] = {}
+        self.chat_edits: Dict[int, deque] = {}
+        self.global_edits = deque()
+        self.blocked_until = 0.0
+        self.stats = {'requested': 0, 'sent': 0, 'unchanged': 0, 'flood_waits': 0, 'errors': 0}
+        self.chat_stats: Dict[int, dict] = {}
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+    
+    @staticmethod
+    def key(msg: Message) -> tuple:
+        return (msg.chat.id, msg.id)
+    
+    def update(self, msg: Message, text: str):
+        """Queue text for msg, replacing any not yet sent"""
+        key = self.key(msg)
+        self.stats['requested'] += 1
+        chat = self.chat_stats.setdefault(key[0], {'requested': 0, 'sent': 0})
+        chat['requested'] += 1
+        
+        if key not in self.pending and self.shown.get(key) == text:
+            self.stats['unchanged'] += 1
+            return
+        
+        self.pending[key] = (msg, text)
+        self._ensure_running()
+        self.wakeup.set()
+    
+    def forget(self, msg: Message):
+        """Drop state of a message that is about to be deleted"""
+        key = self.key(msg)
+        self.pending.pop(key, None)
+        self.shown.pop(key, None)
+        self.last_edit.pop(key, None)
+    
+    async def delete(self, msg: Message):
+        self.forget(msg)
+        try:
+            await msg.delete()
+        except Exception as e:
+            logger.warning(f"Status delete failed: {e}")
+    
+    def saved(self, chat_id: int) -> int:
+        chat = self.chat_stats.get(chat_id, {'requested': 0, 'sent': 0})
+        return chat['requested'] - chat['sent']
+    
+    def _ensure_running(self):
+        if self.task is None or self.task.done() or self.task.get_loop() is not asyncio.get_running_loop():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self._run())
+    
+    def _budget_ok(self, chat_id: int, now: float) -> bool:
+        chat = self.chat_edits.setdefault(chat_id, deque())
+        while chat and now - chat[0] > 60:
+            chat.popleft()
+        while self.global_edits and now - self.global_edits[0] > 1:
+            self.global_edits.popleft()
+        return len(chat) < CHAT_EDITS_PER_MINUTE and len(self.global_edits) < GLOBAL_EDITS_PER_SECOND
+    
+    def _next_ready(self, now: float) -> Tuple[Optional[tuple], float]:
+        """Oldest pending message allowed to edit now, else seconds to wait"""
+        wait = 1.0
+        for key in self.pending:
+            due = self.last_edit.get(key, 0) + PROGRESS_MIN_INTERVAL
+            if due > now:
+                wait = min(wait, due - now)
+            elif self._budget_ok(key[0], now):
+                return key, 0
+        return None, wait
+    
+    async def _run(self):
+        while True:
+            if not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            
+            key, wait = self._next_ready(now)
+            if key is None:
+                await asyncio.sleep(wait)
+                continue
+            
+            msg, text = self.pending.pop(key)
+            if self.shown.get(key) == text:
+                self.stats['unchanged'] += 1
+                continue
+            
+            self.last_edit[key] = now
+            self.chat_edits[key[0]].append(now)
+            self.global_edits.append(now)
+            try:
+                await msg.edit_text(text)
+                self.shown[key] = text
+                self.stats['sent'] += 1
+                self.chat_stats[key[0]]['sent'] += 1
+            except FloodWait as e:
+                # Shared limit for the whole bot, pause every edit
+                self.stats['flood_waits'] += 1
+                self.blocked_until = time.monotonic() + e.value
+                self.pending.setdefault(key, (msg, text))
+                logger.warning(f"FloodWait {e.value}s on status edits")
+            except MessageNotModified:
+                self.shown[key] = text
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.warning(f"Status edit failed: {e}")
+
+
+progress_renderer = ProgressRenderer()
+
+
+EXTENSION_TYPES = {ext: ftype for ftype, extensions in SUPPORTED_TYPES.items() for ext in extensions}
+
+# Extension must end a path segment or query value, so .doc never matches .docx
+LINK_TYPE_RE = re.compile(
+    r'\.(' + '|'.join(sorted((re.escape(e[1:]) for e in EXTENSION_TYPES), key=len, reverse=True)) + r')'
+    r'(?=$|[/?&#;=])'
+)
+LINK_LINE_RE = re.compile(r'https?://[^\s<>"\']+')
+# Sentence punctuation the link pattern swallows, as in "(https://x/a.pdf)."
+LINK_TRAILING = '.,;:!?)]}'
+ANCHOR_RE = re.compile(
+    r'<a\b[^>]*?\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))[^>]*>(.*?)</a\s*>',
+    re.IGNORECASE | re.DOTALL
+)
+ANCHOR_OPEN_RE = re.compile(r'<a\b', re.IGNORECASE)
+BLOCK_TAG_RE = re.compile(r'<(?:br|/?(?:p|div|li|tr|td|th|h[1-6]|table|ul|ol|body|html))\b[^>]*>', re.IGNORECASE)
+TAG_RE = re.compile(r'<[^>]*>')
+
+PARSE_CHUNK_SIZE = 1024 * 1024
+
+
+def get_file_type(url: str) -> str:
+    """Determine file type from the extension in the URL path, else its query"""
+    url_lower = url.strip().lower()
+    
+    # Skip scheme and host, drop the fragment
+    scheme_end = url_lower.find('://')
+    path_start = url_lower.find('/', scheme_end + 3) if scheme_end >= 0 else 0
+    if path_start < 0:
+        return 'unknown'
+    path, _, query = url_lower[path_start:].split('#', 1)[0].partition('?')
+    
+    path_match = LINK_TYPE_RE.findall(path)
+    if path_match:
+        return EXTENSION_TYPES['.' + path_match[-1]]
+    
+    query_match = LINK_TYPE_RE.findall(query)
+    if query_match:
+        return EXTENSION_TYPES['.' + query_match[0]]
+    
+    return 'unknown'
+
+
+def make_item(title: str, url: str) -> Optional[dict]:
+    file_type = get_file_type(url)
+    if file_type == 'unknown':
+        return None
+    
+    title = title.strip().rstrip(':').strip()
+    if not title:
+        title = unquote(os.path.basename(urlsplit(url).path)) or url
+    return {'title': title, 'url': url, 'type': file_type}
+
+
+def trim_link(url: str) -> str:
+    """Drop punctuation glued to the end of a link, parentheses only when unbalanced"""
+    while url and url[-1] in LINK_TRAILING:
+        if url[-1] == ')' and url.count('(') >= url.count(')'):
+            break
+        url = url[:-1]
+    return url
+
+
+def parse_line(line: str) -> Optional[dict]:
+    """'title: url' line to an item, None when there is no supported link"""
+    match = LINK_LINE_RE.search(line)
+    if not match:
+        return None
+    # A bracket opened right before the link goes with it, not the title
+    return make_item(line[:match.start()].rstrip().rstrip('(['), trim_link(match.group(0)))
+
+
+def parse_content(text: str) -> list:
+    """Parse content and identify all supported file types"""
+    items = []
+    for line in text.splitlines():
+        item = parse_line(line)
+        if item:
+            items.append(item)
+    return items
+
+
+def parse_html_text(fragment: str) -> list:
+    """'title: url' lines in markup outside of anchors"""
+    if 'http' not in fragment:
+        return []
+    text = html.unescape(TAG_RE.sub('', BLOCK_TAG_RE.sub('\n', fragment)))
+    return parse_content(text)
+
+
+def scan_html(buffer: str, final: bool) -> Tuple[list, str]:
+    """Items found in buffer and the unparsed tail to carry into the next chunk"""
+    items = []
+    pos = 0
+    
+    for match in ANCHOR_RE.finditer(buffer):
+        items.extend(parse_html_text(buffer[pos:match.start()]))
+        pos = match.end()
+        
+        url = html.unescape(match.group(1) or match.group(2) or match.group(3) or '').strip()
+        if url.startswith(('http://', 'https://')):
+            title = ' '.join(html.unescape(TAG_RE.sub('', match.group(4))).split())
+            item = make_item(title, url)
+            if item:
+                items.append(item)
+    
+    rest = buffer[pos:]
+    if final:
+        items.extend(parse_html_text(rest))
+        return items, ''
+    
+    # Keep an unclosed anchor or the last partial line for the next chunk
+    cut = -1
+    for cut_match in ANCHOR_OPEN_RE.finditer(rest):
+        cut = cut_match.start()
+    if cut < 0 or len(rest) - cut > PARSE_CHUNK_SIZE:
+        cut = max(rest.rfind('\n'), rest.rfind('>') + 1, 0)
+    items.extend(parse_html_text(rest[:cut]))
+    return items, rest[cut:]
+
+
+async def iter_links(path: str):
+    """Stream a TXT/HTML file and yield items as they are found"""
+    is_html = path.lower().endswith(('.html', '.htm'))
+    tail = ''
+    
+    async with aiofiles.open(path, 'r', encoding='utf-8', errors='replace') as f:
+        while True:
+            chunk = await f.read(PARSE_CHUNK_SIZE)
+            if not chunk:
+                break
+            
+            if is_html:
+                found, tail = scan_html(tail + chunk, final=False)
+                for item in found:
+                    yield item
+                continue
+            
+            lines = (tail + chunk).split('\n')
+            tail = lines.pop()
+            for line in lines:
+                item = parse_line(line)
+                if item:
+                    yield item
+    
+    if is_html:
+        found, _ = scan_html(tail, final=True)
+        for item in found:
+            yield item
+    elif tail:
+        item = parse_line(tail)
+        if item:
+            yield item
+
+
+async def run_media_tool(cmd: list, timeout: float) -> Tuple[int, bytes, bytes]:
+    """Run ffmpeg/ffprobe without blocking the event loop, killed on timeout or cancel"""
+    async with media_semaphore:
+        metrics.media_in_flight += 1
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+            except BaseException:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
+            return proc.returncode, stdout, stderr
+        finally:
+            metrics.media_in_flight -= 1
+
+
+THUMB_SEEK = 2.0
+
+
+async def get_video_info(filepath: str) -> dict:
+    """Get video duration and dimensions"""
+    try:
+        cmd = [
+            'ffprobe', '-v', 'quiet',
+            '-print_format', 'json',
+            '-show_format', '-show_streams',
+            filepath
+        ]
+        _, stdout, _ = await run_media_tool(cmd, timeout=15)
+        
+        data = json.loads(stdout)
+        
+        duration = int(float(data.get('format', {}).get('duration', 0)))
+        
+        video_stream = next((s for s in data.get('streams', []) if s.get('codec_type') == 'video'), {})
+        width = video_stream.get('width', 1280)
+        height = video_stream.get('height', 720)
+        
+        return {'duration': duration, 'width': width, 'height': height}
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"FFprobe error: {e}")
+        return {'duration': 0, 'width': 1280, 'height': 720}
+
+
+async def generate_thumbnail(video_path: str, thumb_path: str, seek: float = THUMB_SEEK) -> bool:
+    """Generate thumbnail from video, seeking to a keyframe before decoding"""
+    try:
+        cmd = [
+            'ffmpeg', '-ss', f'{seek:.3f}', '-i', video_path,
+            '-vframes', '1',
+            '-vf', 'scale=320:180',
+            '-q:v', '2',
+            thumb_path,
+            '-y'
+        ]
+        await run_media_tool(cmd, timeout=30)
+        
+        if os.path.exists(thumb_path) and os.path.getsize(thumb_path) > 1024:
+            return True
+        return False
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Thumbnail error: {e}")
+        return False
+
+
+# Telegram refuses bigger uploads (UPLOAD_LIMIT), such videos go out as stream-copied parts
+SPLIT_HEADROOM = 0.95
+
+
+async def plan_cuts(filepath: str, limit: int) -> list:
+    """Keyframe times that cut filepath into pieces of at most limit bytes
+
+    Sizes come from the video packets, scaled up to the file size to account
+    for audio and container overhead. Empty when the file can't be planned.
+    """
+    returncode, stdout, _ = await run_media_tool([
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,size,flags', '-of', 'csv=p=0',
+        filepath
+    ], timeout=600)
+    if returncode != 0:
+        return []
+    
+    packets = []
+    for line in stdout.decode(errors='replace').splitlines():
+        fields = line.split(',')
+        if len(fields) < 3 or fields[1] == 'N/A':
+            continue
+        pts = None if fields[0] == 'N/A' else float(fields[0])
+        packets.append((pts, int(fields[1]), fields[2].startswith('K')))
+    
+    video_bytes = sum(size for _, size, _ in packets)
+    if not video_bytes:
+        return []
+    target = limit * SPLIT_HEADROOM * video_bytes / os.path.getsize(filepath)
+    
+    cuts = []
+    total = part_start = 0
+    key_time, key_bytes = None, 0
+    for pts, size, is_key in packets:
+        if is_key and pts is not None:
+            # Part would run past this keyframe, end it at the previous one
+            if total - part_start > target and key_time is not None and key_bytes > part_start:
+                cuts.append(key_time)
+                part_start = key_bytes
+            key_time, key_bytes = pts, total
+        total += size
+    if total - part_start > target and key_time is not None and key_bytes > part_start:
+        cuts.append(key_time)
+    return cuts
+
+
+async def cut_part(src: str, dst: str, start: float, end: Optional[float]) -> bool:
+    """Stream-copy src from the keyframe at start up to end into dst"""
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-ss', repr(start), '-i', src]
+    if end is not None:
+        cmd += ['-t', repr(end - start)]
+    cmd += ['-map', '0:v', '-map', '0:a?', '-c', 'copy',
+            '-avoid_negative_ts', 'make_zero', '-movflags', '+faststart', dst]
+    try:
+        returncode, _, stderr = await run_media_tool(cmd, timeout=1800)
+    except asyncio.TimeoutError:
+        returncode, stderr = -1, b'timeout'
+    except OSError as e:
+        returncode, stderr = -1, str(e).encode()
+    if returncode != 0:
+        logger.error(f"Split error: {stderr.decode(errors='replace')[-300:]}")
+        return False
+    return os.path.exists(dst) and os.path.getsize(dst) > 10240
+
+
+# Resumable file downloads: <name>.part holds the bytes, <name>.part.json the validators
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "6"))
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=120)
+
+# Files up to this size stay in memory and are uploaded from a BytesIO
+MEMORY_THRESHOLD = int(os.getenv("MEMORY_THRESHOLD_MB", "16")) * 1024 * 1024
+DISK_WRITE_BUFFER = 1024 * 1024
+
+
+class RetryableDownloadError(Exception):
+    """Server answered with a status worth retrying (5xx, 429)"""
+
+
+def load_partial_state(state_path: Path, url: str) -> Optional[dict]:
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+        if state.get('url') == url:
+            return state
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def save_partial_state(state_path: Path, state: dict):
+    tmp = state_path.with_name(state_path.name + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, state_path)
+
+
+def remove_partial(part_path: Path, state_path: Path):
+    for p in (part_path, state_path):
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+
+# Segmented mode for large files on servers that accept byte ranges
+SEGMENT_CONNECTIONS = int(os.getenv("SEGMENT_CONNECTIONS", "4"))
+SEGMENT_MIN_SIZE = int(os.getenv("SEGMENT_MIN_SIZE_MB", "32")) * 1024 * 1024
+SEGMENT_BUFFER_MIN = 256 * 1024
+SEGMENT_BUFFER_MAX = 8 * 1024 * 1024
+
+
+class RangeNotHonored(Exception):
+    """Server ignored a byte range request, or answered it with other bytes"""
+
+
+CONTENT_RANGE_RE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)', re.IGNORECASE)
+
+
+def parse_content_range(value: Optional[str]) -> Optional[Tuple[int, int, Optional[int]]]:
+    """(first, last, total) of a bytes Content-Range, total None when the server sent *"""
+    m = CONTENT_RANGE_RE.fullmatch((value or '').strip())
+    if not m:
+        return None
+    return int(m[1]), int(m[2]), None if m[3] == '*' else int(m[3])
+
+
+def plan_segments(total_size: int, connections: int) -> list:
+    """[start, end, done] byte ranges covering the file, end inclusive"""
+    step = -(-total_size // connections)
+    return [[start, min(start + step, total_size) - 1, 0] for start in range(0, total_size, step)]
+
+
+async def fetch_segment(url: str, seg: list, total_size: int, validator: Optional[str], fd: int,
+                        on_flush, user_id: int):
+    """Stream one byte range into fd at its offset"""
+    start, end, done = seg
+    if start + done > end:
+        return
+    
+    headers = {'Range': f"bytes={start + done}-{end}"}
+    if validator:
+        headers['If-Range'] = validator
+    
+    loop = asyncio.get_event_loop()
+    async with host_request('GET', url, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status == 429 or response.status >= 500:
+            raise RetryableDownloadError(f"HTTP {response.status}")
+        if response.status != 206:
+            raise RangeNotHonored(f"HTTP {response.status} for segment {start}-{end}")
+        content_range = response.headers.get('Content-Range')
+        rng = parse_content_range(content_range)
+        if not rng or rng[0] != start + done or rng[1] > end or rng[2] not in (None, total_size):
+            raise RangeNotHonored(f"Content-Range {content_range!r} for segment {start + done}-{end}/{total_size}")
+        
+        buffer = bytearray()
+        target = SEGMENT_BUFFER_MIN
+        filled_at = loop.time()
+        
+        async def flush():
+            nonlocal filled_at, target
+            data = bytes(buffer)
+            buffer.clear()
+            await loop.run_in_executor(None, os.pwrite, fd, data, start + seg[2])
+            seg[2] += len(data)
+            
+            # Size the buffer to roughly half a second of this connection's throughput
+            now = loop.time()
+            rate = len(data) / max(now - filled_at, 1e-3)
+            target = int(min(SEGMENT_BUFFER_MAX, max(SEGMENT_BUFFER_MIN, rate / 2)))
+            filled_at = now
+            on_flush()
+        
+        try:
+            async for chunk in response.content.iter_chunked(65536):
+                if not active_downloads.get(user_id, False):
+                    return
+                buffer += chunk
+                if len(buffer) >= target:
+                    await flush()
+        finally:
+            if buffer:
+                await flush()
+
+
+async def download_segmented(url: str, part_path: Path, state_path: Path, state: dict,
+                             progress_msg: Message, user_id: int) -> Optional[bool]:
+    """Fetch state['segments'] over parallel connections into a preallocated file"""
+    total_size = state['size']
+    segments = state['segments']
+    validator = state.get('etag') or state.get('last_modified')
+    
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size != total_size:
+            os.ftruncate(fd, total_size)
+        
+        start_time = asyncio.get_event_loop().time()
+        resumed = sum(s[2] for s in segments)
+        last = {'saved': start_time, 'bytes': 0}
+        
+        def on_flush():
+            downloaded = sum(s[2] for s in segments)
+            now = asyncio.get_event_loop().time()
+            if now - last['saved'] >= 1:
+                last['saved'] = now
+                save_partial_state(state_path, state)
+            if downloaded - last['bytes'] >= 1024 * 1024:
+                last['bytes'] = downloaded
+                speed = (downloaded - resumed) / max(now - start_time, 1e-3)
+                progress_renderer.update(
+                    progress_msg,
+                    f"📥 Downloading ({len(segments)} connections)...\n\n"
+                    f"Progress: {downloaded / total_size * 100:.1f}%\n"
+                    f"Size: {downloaded/(1024*1024):.1f}MB / {total_size/(1024*1024):.1f}MB\n"
+                    f"Speed: {speed/(1024*1024):.2f} MB/s"
+                )
+        
+        tasks = [asyncio.create_task(fetch_segment(url, seg, total_size, validator, fd, on_flush, user_id))
+                 for seg in segments]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            save_partial_state(state_path, state)
+    finally:
+        os.close(fd)
+    
+    if not active_downloads.get(user_id, False):
+        remove_partial(part_path, state_path)
+        return None
+    
+    if any(s[0] + s[2] <= s[1] for s in segments):
+        raise aiohttp.ClientPayloadError("Segment ended early")
+    return True
+
+
+async def download_file_attempt(url: str, filename: str, part_path: Path, state_path: Path,
+                                progress_msg: Message, user_id: int, allow_segments: bool = True):
+    """One transfer, resuming part_path if its validators still match
+
+    Small bodies are kept in memory and returned as a BytesIO, larger ones
+    spill to part_path. Returns True when complete on disk, the buffer when
+    complete in memory, None when cancelled or not downloadable.
+    """
+    state = load_partial_state(state_path, url) if part_path.exists() else None
+    validator = state and (state.get('etag') or state.get('last_modified'))
+    
+    if state and state.get('segments'):
+        if validator and allow_segments:
+            return await download_segmented(url, part_path, state_path, state, progress_msg, user_id)
+        state = None
+    
+    offset = part_path.stat().st_size if state else 0
+    
+    headers = {}
+    if offset and validator:
+        headers['Range'] = f"bytes={offset}-"
+        headers['If-Range'] = validator
+    else:
+        offset = 0
+    
+    async with host_request('GET', url, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status == 416 and state and state.get('size') == offset:
+            return True
+        if response.status == 429 or response.status >= 500:
+            raise RetryableDownloadError(f"HTTP {response.status}")
+        if response.status not in (200, 206):
+            logger.error(f"File download HTTP {response.status}: {url}")
+            return None
+        
+        if response.status == 200:
+            # Fresh body, either first try or the validator no longer matches
+            offset = 0
+        
+        length = int(response.headers.get('content-length', 0))
+        total_size = offset + length if length else 0
+        if response.status == 206:
+            # Appending bytes from anywhere but offset, or of another size, splices two files
+            content_range = response.headers.get('Content-Range')
+            rng = parse_content_range(content_range)
+            expected = state.get('size') if state else None
+            if not rng or rng[0] != offset or (expected and rng[2] not in (None, expected)):
+                raise RangeNotHonored(f"Content-Range {content_range!r} for a resume at {offset}/{expected}")
+            if rng[2] is not None:
+                total_size = rng[2]
+        new_state = {
+            'url': url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'size': total_size
+        }
+        
+        in_memory = offset == 0 and total_size <= MEMORY_THRESHOLD
+        if not in_memory:
+            disk_budget.update(user_id, total_size - offset)
+        segmented = (
+            allow_segments
+            and offset == 0
+            and SEGMENT_CONNECTIONS > 1
+            and total_size >= SEGMENT_MIN_SIZE
+            and response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        )
+        
+        if segmented:
+            # Drop this stream and refetch as parallel ranges, once its host slot is free
+            new_state['segments'] = plan_segments(total_size, SEGMENT_CONNECTIONS)
+            save_partial_state(state_path, new_state)
+            response.close()
+        else:
+            if not in_memory:
+                save_partial_state(state_path, new_state)
+            
+            buffer = bytearray()
+            f = None
+            downloaded = offset
+            start_time = asyncio.get_event_loop().time()
+            last_update = 0
+            
+            try:
+                if not in_memory:
+                    f = await aiofiles.open(part_path, 'ab' if offset else 'wb')
+            
+                async for chunk in response.content.iter_chunked(65536):
+                    if not active_downloads.get(user_id, False):
+                        if f:
+                            await f.close()
+                            f = None
+                        remove_partial(part_path, state_path)
+                        return None
+                
+                    buffer += chunk
+                    downloaded += len(chunk)
+                
+                    if in_memory and len(buffer) > MEMORY_THRESHOLD:
+                        # No usable Content-Length and it grew too big, continue on disk
+                        in_memory = False
+                        save_partial_state(state_path, new_state)
+                        f = await aiofiles.open(part_path, 'wb')
+                
+                    if not in_memory and len(buffer) >= DISK_WRITE_BUFFER:
+                        await f.write(buffer)
+                        buffer.clear()
+                
+                    if downloaded - last_update >= 1024 * 1024:
+                        last_update = downloaded
+                        percent = (downloaded / total_size * 100) if total_size > 0 else 0
+                        elapsed = asyncio.get_event_loop().time() - start_time
+                        speed = (downloaded - offset) / elapsed if elapsed > 0 else 0
+                    
+                        progress_renderer.update(
+                            progress_msg,
+                            f"📥 Downloading...\n\n"
+                            f"Progress: {percent:.1f}%\n"
+                            f"Size: {downloaded/(1024*1024):.1f}MB / {total_size/(1024*1024):.1f}MB\n"
+                            f"Speed: {speed/(1024*1024):.2f} MB/s"
+                        )
+            
+                if f and buffer:
+                    await f.write(buffer)
+                    buffer.clear()
+            finally:
+                if f:
+                    # Flush what arrived so a retry resumes after it
+                    if buffer:
+                        await f.write(buffer)
+                    await f.close()
+            
+            if total_size and downloaded < total_size:
+                raise aiohttp.ClientPayloadError(f"Short read {downloaded}/{total_size}")
+            
+            if in_memory:
+                data = io.BytesIO(buffer)
+                data.name = filename
+                return data
+            return True
+    
+    # Outside the probe's host slot, every range request takes its own
+    return await download_segmented(url, part_path, state_path, new_state, progress_msg, user_id)
+
 
-DOWNLOAD_DIR = Path("downloads")
-DOWNLOAD_DIR.mkdir(exist_ok=True)
+async def download_file(url: str, filename: str, progress_msg: Message, user_id: int,
+                        workdir: Optional[Path] = None) -> Union[str, io.BytesIO, None]:
+    """Universal file downloader for images, PDFs, and other documents
 
-QUALITY_MAP = {
-    "360p": "360",
-    "480p": "480", 
-    "720p": "720",
-    "1080p": "1080",
-}
+    Returns a path in workdir (default DOWNLOAD_DIR), or a named BytesIO for
+    files under MEMORY_THRESHOLD.
+    """
+    filepath = (workdir or DOWNLOAD_DIR) / filename
+    part_path = filepath.with_name(filepath.name + '.part')
+    state_path = filepath.with_name(filepath.name + '.part.json')
+    
+    allow_segments = True
+    
+    for attempt in range(DOWNLOAD_RETRIES):
+        try:
+            done = await download_file_attempt(url, filename, part_path, state_path,
+                                               progress_msg, user_id, allow_segments)
+            if not done:
+                return None
+            if isinstance(done, io.BytesIO):
+                return done
+            
+            os.replace(part_path, filepath)
+            remove_partial(part_path, state_path)
+            return str(filepath)
+        except asyncio.CancelledError:
+            # Stopped by the user: nothing will resume this, free the space now.
+            # On shutdown the partial stays for the next run.
+            if not active_downloads.get(user_id, False):
+                remove_partial(part_path, state_path)
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError, RetryableDownloadError) as e:
+            if attempt == DOWNLOAD_RETRIES - 1 or not active_downloads.get(user_id, False):
+                logger.error(f"File download error: {e}")
+                return None
+            
+            delay = min(60, 2 ** attempt)
+            logger.warning(f"File download error: {e}, retry {attempt + 1} in {delay}s")
+            progress_renderer.update(progress_msg, f"⚠️ Connection issue, resuming in {delay}s...")
+            await asyncio.sleep(delay)
+        except RangeNotHonored as e:
+            logger.warning(f"{e}, restarting from byte 0 as a single stream")
+            remove_partial(part_path, state_path)
+            allow_segments = False
+        except HostUnavailable:
+            # Keep the partial, the item is retried once the host is back
+            raise
+        except Exception as e:
+            logger.error(f"File download error: {e}")
+            return None
+    return None
 
-# Supported file types
-SUPPORTED_TYPES = {
-    'video': ['.m3u8', '.mpd', '.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv', '.webm', '.ts'],
-    'image': ['.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp', '.svg'],
-    'document': ['.pdf', '.doc', '.docx', '.txt', '.zip', '.rar']
-}
 
-# Web server
-from aiohttp import web
-web_app = web.Application()
+# Native HLS engine, yt-dlp stays the fallback for anything else
+NATIVE_HLS = os.getenv("NATIVE_HLS", "1") == "1"
+HLS_SEGMENT_WORKERS = int(os.getenv("HLS_SEGMENT_WORKERS", "8"))
+HLS_SEGMENT_RETRIES = 3
 
-async def health_check(request):
-    return web.Response(text="OK")
+M3U8_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
 
-web_app.router.add_get("/", health_check)
-web_app.router.add_get("/health", health_check)
 
+class HlsUnsupported(Exception):
+    """Playlist uses features the native engine does not handle"""
 
-def get_file_type(url: str) -> str:
-    """Determine file type from URL"""
-    url_lower = url.lower()
+
+def is_hls_url(url: str) -> bool:
+    return urlparse(url).path.lower().endswith('.m3u8')
+
+
+def parse_m3u8_attrs(line: str) -> dict:
+    attrs = line.split(':', 1)[1] if ':' in line else ''
+    return {k: v.strip('"') for k, v in M3U8_ATTR_RE.findall(attrs)}
+
+
+def parse_master_playlist(text: str, base_url: str) -> list:
+    """Variants of a master playlist as {'url', 'height', 'bandwidth'}"""
+    variants = []
+    attrs = None
     
-    for ftype, extensions in SUPPORTED_TYPES.items():
-        if any(ext in url_lower for ext in extensions):
-            return ftype
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-MEDIA:'):
+            media = parse_m3u8_attrs(line)
+            if media.get('TYPE') == 'AUDIO' and media.get('URI'):
+                # Separate audio rendition would need a merge step
+                raise HlsUnsupported("alternate audio rendition")
+        elif line.startswith('#EXT-X-STREAM-INF:'):
+            attrs = parse_m3u8_attrs(line)
+        elif line and not line.startswith('#') and attrs is not None:
+            resolution = attrs.get('RESOLUTION', '')
+            height = int(resolution.split('x')[1]) if 'x' in resolution else 0
+            variants.append({
+                'url': urljoin(base_url, line),
+                'height': height,
+                'bandwidth': int(attrs.get('BANDWIDTH', 0) or 0)
+            })
+            attrs = None
     
-    return 'unknown'
+    return variants
 
 
-def parse_content(text: str) -> list:
-    """Parse content and identify all supported file types"""
-    lines = text.strip().split('\n')
-    items = []
+def pick_variant(variants: list, quality: str) -> dict:
+    """Best variant at or below the requested height, else the smallest one"""
+    limit = int(quality)
+    key = lambda v: (v['height'], v['bandwidth'])
+    
+    fitting = [v for v in variants if v['height'] <= limit]
+    if fitting:
+        return max(fitting, key=key)
+    return min(variants, key=key)
+
+
+def parse_media_playlist(text: str, base_url: str) -> list:
+    """Segments of a media playlist as {'url', 'key', 'iv', 'seq'}"""
+    if '#EXT-X-ENDLIST' not in text:
+        raise HlsUnsupported("live playlist")
+    
+    segments = []
+    seq = 0
+    key = None
+    
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            seq = int(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-KEY:'):
+            attrs = parse_m3u8_attrs(line)
+            method = attrs.get('METHOD', 'NONE')
+            if method == 'NONE':
+                key = None
+            elif method == 'AES-128' and attrs.get('URI'):
+                key = {'uri': urljoin(base_url, attrs['URI']), 'iv': attrs.get('IV')}
+            else:
+                raise HlsUnsupported(f"key method {method}")
+        elif line.startswith(('#EXT-X-BYTERANGE', '#EXT-X-MAP')):
+            raise HlsUnsupported(line.split(':', 1)[0])
+        elif line and not line.startswith('#'):
+            iv = None
+            if key:
+                iv = bytes.fromhex(key['iv'][2:]) if key['iv'] else seq.to_bytes(16, 'big')
+            segments.append({
+                'url': urljoin(base_url, line),
+                'key': key['uri'] if key else None,
+                'iv': iv,
+                'seq': seq
+            })
+            seq += 1
+    
+    return segments
+
+
+async def fetch_bytes(url: str, timeout: int = 60) -> bytes:
+    async with host_request('GET', url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+        response.raise_for_status()
+        return await response.read()
+
+
+async def fetch_hls_segment(seg: dict, keys: dict) -> bytes:
+    for attempt in range(HLS_SEGMENT_RETRIES):
+        try:
+            data = await fetch_bytes(seg['url'])
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == HLS_SEGMENT_RETRIES - 1:
+                raise
+            await asyncio.sleep(2 ** attempt)
     
-    for line in lines:
-        if ':' in line and ('http://' in line or 'https://' in line):
-            parts = line.split(':', 1)
-            if len(parts) == 2:
-                title = parts[0].strip()
-                url = parts[1].strip()
+    if seg['key']:
+        if seg['key'] not in keys:
+            keys[seg['key']] = asyncio.ensure_future(fetch_bytes(seg['key']))
+        key = await keys[seg['key']]
+        loop = asyncio.get_event_loop()
+        data = await loop.run_in_executor(None, decrypt_aes128, data, key, seg['iv'])
+    
+    return data
+
+
+def decrypt_aes128(data: bytes, key: bytes, iv: bytes) -> bytes:
+    return unpad_pkcs7(aes_cbc_decrypt_bytes(data, key, iv))
+
+
+async def fetch_hls_stream(url: str, quality: str, raw_path: str, user_id: int) -> bool:
+    """Fetch all segments in parallel and write them in order to raw_path"""
+    text = (await fetch_bytes(url)).decode('utf-8', 'replace')
+    playlist_url = url
+    
+    if '#EXT-X-STREAM-INF' in text:
+        variants = parse_master_playlist(text, url)
+        if not variants:
+            raise HlsUnsupported("empty master playlist")
+        playlist_url = pick_variant(variants, quality)['url']
+        text = (await fetch_bytes(playlist_url)).decode('utf-8', 'replace')
+    
+    segments = parse_media_playlist(text, playlist_url)
+    if not segments:
+        raise HlsUnsupported("no segments")
+    
+    keys = {}
+    window = deque()
+    pending = iter(segments)
+    downloaded = 0
+    start_time = asyncio.get_event_loop().time()
+    
+    def schedule():
+        seg = next(pending, None)
+        if seg is not None:
+            window.append(asyncio.create_task(fetch_hls_segment(seg, keys)))
+    
+    try:
+        for _ in range(HLS_SEGMENT_WORKERS):
+            schedule()
+        
+        async with aiofiles.open(raw_path, 'wb') as f:
+            for done in range(1, len(segments) + 1):
+                if not active_downloads.get(user_id, False):
+                    return False
                 
-                file_type = get_file_type(url)
+                # Window keeps HLS_SEGMENT_WORKERS fetches ahead of the writer
+                data = await window.popleft()
+                schedule()
+                await f.write(data)
+                downloaded += len(data)
                 
-                if file_type != 'unknown':
-                    items.append({
-                        'title': title, 
-                        'url': url, 
-                        'type': file_type
-                    })
-    
-    return items
+                elapsed = asyncio.get_event_loop().time() - start_time
+                speed = downloaded / elapsed if elapsed > 0 else 0
+                total = downloaded * len(segments) / done
+                download_progress[user_id] = {
+                    'percent': done / len(segments) * 100,
+                    'downloaded': downloaded,
+                    'total': total,
+                    'speed': speed,
+                    'eta': (total - downloaded) / speed if speed > 0 else 0
+                }
+        return True
+    finally:
+        for task in window:
+            task.cancel()
+        await asyncio.gather(*window, return_exceptions=True)
 
 
-def get_video_info(filepath: str) -> dict:
-    """Get video duration and dimensions"""
+async def download_hls_native(url: str, quality: str, output_path: str, user_id: int) -> bool:
+    """Native HLS download remuxed to mp4, raises HlsUnsupported for yt-dlp fallback"""
+    raw_path = output_path + '.part.ts'
+    
     try:
-        cmd = [
-            'ffprobe', '-v', 'quiet',
-            '-print_format', 'json',
-            '-show_format', '-show_streams',
-            filepath
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=15)
+        if not await fetch_hls_stream(url, quality, raw_path, user_id):
+            return False
         
-        import json
-        data = json.loads(result.stdout)
+        returncode, _, stderr = await run_media_tool([
+            'ffmpeg', '-v', 'error', '-y',
+            '-i', raw_path,
+            '-c', 'copy', '-movflags', '+faststart',
+            output_path
+        ], timeout=1800)
         
-        duration = int(float(data.get('format', {}).get('duration', 0)))
+        if returncode != 0:
+            logger.error(f"HLS remux error: {stderr.decode(errors='replace')[-300:]}")
+            return False
+        return True
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+
+
+# Per-host yt-dlp tuning: (fragments, buffersize, http_chunk_size) ladder,
+# climbed while throughput improves and stepped down on throttling
+TUNING_LEVELS = [
+    (1, 65536, 262144),
+    (2, 131072, 524288),
+    (4, 131072, 524288),
+    (8, 262144, 1048576),
+    (12, 524288, 2097152),
+    (16, 1048576, 4194304),
+]
+TUNING_START_LEVEL = 2
+TUNING_MIN_BYTES = 4 * 1024 * 1024
+TUNING_MAX_ERROR_RATE = float(os.getenv("TUNING_MAX_ERROR_RATE", "0.05"))
+TUNING_REPROBE_JOBS = int(os.getenv("TUNING_REPROBE_JOBS", "20"))
+
+
+class HostTuner:
+    """Learned yt-dlp fragment concurrency and chunk sizes per origin host, kept in SQLite"""
+    
+    def __init__(self, path: Path):
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+    
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self.conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(str(self.path))
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS host_tuning ("
+                "host TEXT PRIMARY KEY, level INTEGER, ceiling INTEGER, rates TEXT, "
+                "jobs INTEGER, updated REAL)"
+            )
+            self.conn.commit()
+        return self.conn
+    
+    def state(self, host: str) -> dict:
+        row = self.db.execute(
+            "SELECT level, ceiling, rates, jobs FROM host_tuning WHERE host = ?", (host,)
+        ).fetchone()
+        if row is None:
+            return {'level': TUNING_START_LEVEL, 'ceiling': len(TUNING_LEVELS) - 1,
+                    'rates': [None] * len(TUNING_LEVELS), 'jobs': 0}
+        return {'level': row[0], 'ceiling': row[1], 'rates': json.loads(row[2]), 'jobs': row[3]}
+    
+    def settings(self, host: str) -> dict:
+        level = self.state(host)['level']
+        fragments, buffersize, chunk = TUNING_LEVELS[level]
+        return {'level': level, 'fragments': fragments, 'buffersize': buffersize, 'http_chunk_size': chunk}
+    
+    def record(self, host: str, level: int, job_stats: dict):
+        """Fold one finished job into the host's state and pick the next level"""
+        state = self.state(host)
+        rates = state['rates']
+        seconds = (job_stats['end'] or 0) - (job_stats['start'] or 0)
+        error_rate = job_stats['retries'] / max(job_stats['fragments'], 1)
         
-        video_stream = next((s for s in data.get('streams', []) if s.get('codec_type') == 'video'), {})
-        width = video_stream.get('width', 1280)
-        height = video_stream.get('height', 720)
+        if job_stats['bytes'] >= TUNING_MIN_BYTES and seconds > 0:
+            rate = job_stats['bytes'] / seconds
+            old = rates[level]
+            rates[level] = rate if old is None else old * 0.7 + rate * 0.3
+            logger.info(
+                f"Host {host}: {rate / (1024 * 1024):.1f} MB/s with "
+                f"{TUNING_LEVELS[level][0]} fragments, {job_stats['retries']} retries"
+            )
         
-        return {'duration': duration, 'width': width, 'height': height}
-    except Exception as e:
-        logger.error(f"FFprobe error: {e}")
-        return {'duration': 0, 'width': 1280, 'height': 720}
+        if job_stats['throttled'] or error_rate > TUNING_MAX_ERROR_RATE:
+            state['ceiling'] = max(0, level - 1)
+            state['level'] = state['ceiling']
+        elif rates[level] is not None:
+            up, down = level + 1, level - 1
+            if up <= state['ceiling'] and (rates[up] is None or rates[up] > rates[level] * 1.05):
+                state['level'] = up
+            elif down >= 0 and rates[down] is not None and rates[down] > rates[level] * 1.05:
+                state['level'] = down
+        
+        state['jobs'] += 1
+        if state['jobs'] % TUNING_REPROBE_JOBS == 0:
+            # CDN limits change, forget the ceiling and what lies above the current level
+            state['ceiling'] = len(TUNING_LEVELS) - 1
+            for i in range(state['level'] + 1, len(rates)):
+                rates[i] = None
+        
+        if state['level'] != level:
+            logger.info(f"Host {host}: fragments {TUNING_LEVELS[level][0]} -> {TUNING_LEVELS[state['level']][0]}")
+        
+        self.db.execute(
+            "INSERT OR REPLACE INTO host_tuning VALUES (?, ?, ?, ?, ?, ?)",
+            (host, state['level'], state['ceiling'], json.dumps(rates), state['jobs'], time.time())
+        )
+        self.db.commit()
+    
+    def summary(self) -> dict:
+        rows = self.db.execute("SELECT host, level, rates, jobs FROM host_tuning").fetchall()
+        return {
+            host: {
+                'fragments': TUNING_LEVELS[level][0],
+                'mbps': round((json.loads(rates)[level] or 0) / (1024 * 1024), 2),
+                'jobs': jobs,
+            }
+            for host, level, rates, jobs in rows
+        }
 
 
-def generate_thumbnail(video_path: str, thumb_path: str) -> bool:
-    """Generate thumbnail from video"""
-    try:
-        cmd = [
-            'ffmpeg', '-i', video_path,
-            '-ss', '00:00:02',
-            '-vframes', '1',
-            '-vf', 'scale=320:180',
-            '-q:v', '2',
-            thumb_path,
-            '-y'
-        ]
-        result = subprocess.run(cmd, capture_output=True, timeout=30)
-        
-        if os.path.exists(thumb_path) and os.path.getsize(thumb_path) > 1024:
-            return True
-        return False
-    except Exception as e:
-        logger.error(f"Thumbnail error: {e}")
-        return False
+host_tuner = HostTuner(DATA_DIR / "host_tuning.db")
 
 
-async def download_file(url: str, filename: str, progress_msg: Message, user_id: int) -> Optional[str]:
-    """Universal file downloader for images, PDFs, and other documents"""
-    try:
-        filepath = DOWNLOAD_DIR / filename
-        
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE
-        
-        connector = aiohttp.TCPConnector(ssl=ssl_context, limit=20)
-        
-        async with aiohttp.ClientSession(connector=connector) as session:
-            headers = {'User-Agent': 'Mozilla/5.0'}
-            async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=1800)) as response:
-                if response.status == 200:
-                    total_size = int(response.headers.get('content-length', 0))
-                    downloaded = 0
-                    start_time = asyncio.get_event_loop().time()
-                    last_update = 0
-                    
-                    async with aiofiles.open(filepath, 'wb') as f:
-                        async for chunk in response.content.iter_chunked(16384):
-                            if not active_downloads.get(user_id, False):
-                                if filepath.exists():
-                                    os.remove(filepath)
-                                return None
-                            
-                            await f.write(chunk)
-                            downloaded += len(chunk)
-                            
-                            if downloaded - last_update >= 1024 * 1024:
-                                last_update = downloaded
-                                try:
-                                    percent = (downloaded / total_size * 100) if total_size > 0 else 0
-                                    elapsed = asyncio.get_event_loop().time() - start_time
-                                    speed = downloaded / elapsed if elapsed > 0 else 0
-                                    
-                                    await progress_msg.edit_text(
-                                        f"📥 Downloading...\n\n"
-                                        f"Progress: {percent:.1f}%\n"
-                                        f"Size: {downloaded/(1024*1024):.1f}MB / {total_size/(1024*1024):.1f}MB\n"
-                                        f"Speed: {speed/(1024*1024):.2f} MB/s"
-                                    )
-                                except:
-                                    pass
-                    
-                    return str(filepath)
-        return None
-    except Exception as e:
-        logger.error(f"File download error: {e}")
-        return None
+# yt-dlp messages that mean the host itself is failing, not the video
+UNREACHABLE_SIGNS = ('HTTP Error 500', 'HTTP Error 502', 'HTTP Error 504', 'timed out',
+                     'Connection refused', 'Connection reset', 'Name or service not known',
+                     'Temporary failure in name resolution', 'Network is unreachable')
+
+
+class YtdlpLog:
+    """Routes yt-dlp output to our logger and counts retries and throttling for the tuner"""
+    
+    def __init__(self, job_stats: dict):
+        self.job_stats = job_stats
+    
+    def _note(self, msg: str):
+        if 'Got error' in msg:
+            self.job_stats['retries'] += 1
+            if 'HTTP Error 429' in msg or 'HTTP Error 503' in msg:
+                self.job_stats['throttled'] = True
+        if any(sign in msg for sign in UNREACHABLE_SIGNS):
+            self.job_stats['unreachable'] = True
+    
+    def debug(self, msg: str):
+        self._note(msg)
+    
+    def warning(self, msg: str):
+        self._note(msg)
+    
+    def error(self, msg: str):
+        self._note(msg)
+        logger.error(f"yt-dlp: {msg}")
+
+
+def new_download_metrics() -> dict:
+    return {'start': None, 'end': None, 'bytes': 0, 'fragments': 0, 'retries': 0,
+            'throttled': False, 'unreachable': False}
 
 
-def download_video_sync(url: str, quality: str, output_path: str, user_id: int) -> bool:
-    """Download video using yt-dlp (supports m3u8, mpd, mp4, etc.)"""
+def download_video_sync(url: str, quality: str, output_path: str, user_id: int,
+                        tuning: Optional[dict] = None, job_stats: Optional[dict] = None,
+                        progress=None, stopped=None, media: Optional[dict] = None) -> bool:
+    """Download video using yt-dlp (supports m3u8, mpd, mp4, etc.)
+
+    progress(dict) and stopped() default to the in-process download_progress
+    and active_downloads, worker processes pass IPC-backed ones. media gets
+    the duration and dimensions yt-dlp reports, sparing an ffprobe later.
+    """
+    tuning = tuning or dict(zip(('fragments', 'buffersize', 'http_chunk_size'), TUNING_LEVELS[TUNING_START_LEVEL]))
+    job_stats = job_stats if job_stats is not None else new_download_metrics()
+    
+    if stopped is None:
+        def stopped():
+            return not active_downloads.get(user_id, False)
+    
+    if progress is None:
+        def progress(p):
+            download_progress[user_id] = p
+    
     try:
         def progress_hook(d):
-            if not active_downloads.get(user_id, False):
+            if stopped():
                 raise Exception("Cancelled")
             
+            now = time.monotonic()
+            if d['status'] == 'finished':
+                job_stats['bytes'] += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+                job_stats['end'] = now
+            
             if d['status'] == 'downloading':
+                if job_stats['start'] is None:
+                    job_stats['start'] = now
+                job_stats['fragments'] = max(job_stats['fragments'], d.get('fragment_count') or 1)
                 try:
                     total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
                     downloaded = d.get('downloaded_bytes', 0)
@@ -211,13 +2107,13 @@ def download_video_sync(url: str, quality: str, output_path: str, user_id: int)
                         percent = (downloaded / total) * 100
                         eta = d.get('eta', 0)
                         
-                        download_progress[user_id] = {
+                        progress({
                             'percent': percent,
                             'downloaded': downloaded,
                             'total': total,
                             'speed': speed,
                             'eta': eta
-                        }
+                        })
                 except:
                     pass
         
@@ -227,24 +2123,38 @@ def download_video_sync(url: str, quality: str, output_path: str, user_id: int)
             'merge_output_format': 'mp4',
             'quiet': True,
             'no_warnings': True,
+            'logger': YtdlpLog(job_stats),
             'nocheckcertificate': True,
             'http_headers': {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'},
-            'concurrent_fragment_downloads': 4,
-            'retries': 15,
-            'fragment_retries': 15,
+            'concurrent_fragment_downloads': tuning['fragments'],
+            'sleep_interval_requests': tuning.get('sleep_requests', 0),
+            'retries': tuning.get('retries', YTDLP_RETRIES),
+            'fragment_retries': tuning.get('retries', YTDLP_RETRIES),
             'skip_unavailable_fragments': True,
-            'buffersize': 131072,
-            'http_chunk_size': 524288,
+            'buffersize': tuning['buffersize'],
+            'http_chunk_size': tuning['http_chunk_size'],
+            # +faststart costs a second write of the output, the muxer moves the moov atom
+            # to the front. Worth it: Telegram streams a video only with the index first.
             'postprocessor_args': {'ffmpeg': ['-c', 'copy', '-movflags', '+faststart']},
             'progress_hooks': [progress_hook],
             'extractor_retries': 5,
             'file_access_retries': 5,
+            'continuedl': True,
+            'retry_sleep_functions': {
+                'http': lambda n: min(60, 2 ** n),
+                'fragment': lambda n: min(30, 2 ** n),
+            },
         }
         
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            if not active_downloads.get(user_id, False):
+            if stopped():
                 return False
-            ydl.download([url])
+            info = ydl.extract_info(url, download=True)
+        if media is not None and info:
+            media.update({k: info[k] for k in ('duration', 'width', 'height') if info.get(k)})
+            # Final name after merge and remux postprocessors
+            downloads = info.get('requested_downloads') or [{}]
+            media['filepath'] = downloads[0].get('filepath') or info.get('filepath')
         return True
     except Exception as e:
         logger.error(f"Video download error: {e}")
@@ -268,10 +2178,14 @@ async def update_progress(progress_msg: Message, user_id: int):
                 speed = prog.get('speed', 0)
                 eta = prog.get('eta', 0)
                 
+                # Fragments plus the merged/remuxed copy exist side by side
+                disk_budget.update(user_id, int(total * 2))
+                
                 completed = int(percent / 5)
                 bar = "█" * completed + "░" * (20 - completed)
                 
-                await progress_msg.edit_text(
+                progress_renderer.update(
+                    progress_msg,
                     f"📥 Downloading video...\n\n"
                     f"[{bar}] {percent:.1f}%\n\n"
                     f"Downloaded: {downloaded/(1024*1024):.1f}MB / {total/(1024*1024):.1f}MB\n"
@@ -284,20 +2198,60 @@ async def update_progress(progress_msg: Message, user_id: int):
         await asyncio.sleep(2)
 
 
-async def download_video(url: str, quality: str, filename: str, progress_msg: Message, user_id: int) -> Optional[str]:
-    """Download video with progress tracking"""
-    temp_name = f"temp_{user_id}_{filename.replace('.mp4', '')}"
-    output_path = str(DOWNLOAD_DIR / temp_name)
+async def download_video(url: str, quality: str, filename: str, progress_msg: Message, user_id: int,
+                         info: Optional[dict] = None, workdir: Optional[Path] = None) -> Optional[str]:
+    """Download video into workdir with progress tracking, info gets what yt-dlp knows of the stream"""
+    if workdir is None:
+        workdir = DOWNLOAD_DIR / f"temp_{user_id}_{filename.replace('.mp4', '')}"
+    workdir.mkdir(parents=True, exist_ok=True)
+    output_file = None
     
     try:
         download_progress[user_id] = {'percent': 0}
         
-        await progress_msg.edit_text("📥 Starting download...")
+        progress_renderer.update(progress_msg, "📥 Starting download...")
         
         progress_task = asyncio.create_task(update_progress(progress_msg, user_id))
         
-        loop = asyncio.get_event_loop()
-        success = await loop.run_in_executor(None, download_video_sync, url, quality, output_path, user_id)
+        success = False
+        if NATIVE_HLS and is_hls_url(url):
+            try:
+                output_file = str(workdir / 'video.mp4')
+                success = await download_hls_native(url, quality, output_file, user_id)
+            except HlsUnsupported as e:
+                logger.info(f"Native HLS skipped ({e}), using yt-dlp")
+            except HostUnavailable:
+                raise
+            except Exception as e:
+                logger.error(f"Native HLS error: {e}, using yt-dlp")
+        
+        if not success and active_downloads.get(user_id, False):
+            host = urlparse(url).hostname or ''
+            tuning = dict(host_tuner.settings(host), retries=host_guard.retry_budget(host))
+            # yt-dlp's own connections count against the host's limits too: no
+            # more fragments than the host cap, and its extraction requests paced
+            tuning['fragments'] = max(1, min(tuning['fragments'], HOST_MAX_ACTIVE))
+            tuning['sleep_requests'] = 1 / HOST_RATE if HOST_RATE > 0 else 0
+            async with host_guard.slot(host):
+                job_id, worker = video_pool.submit(url, quality, str(workdir / 'video.%(ext)s'), user_id, tuning)
+                try:
+                    success, job_stats, media = await asyncio.shield(worker)
+                except asyncio.CancelledError:
+                    # The worker stops at its next progress hook, clean up after it
+                    video_pool.cancel(job_id)
+                    asyncio.create_task(discard_after(worker, workdir))
+                    raise
+            if success or job_stats['throttled']:
+                host_tuner.record(host, tuning['level'], job_stats)
+            if success:
+                host_guard.success(host)
+            elif job_stats['throttled']:
+                host_guard.backoff(host, HOST_DEFAULT_BACKOFF)
+            elif job_stats['unreachable']:
+                host_guard.failure(host)
+            output_file = media.pop('filepath', None)
+            if success and info is not None:
+                info.update(media)
         
         if user_id in download_progress:
             del download_progress[user_id]
@@ -310,36 +2264,23 @@ async def download_video(url: str, quality: str, filename: str, progress_msg: Me
         if not success:
             return None
         
-        await progress_msg.edit_text("🔄 Processing...")
-        await asyncio.sleep(1)
+        progress_renderer.update(progress_msg, "🔄 Processing...")
         
-        # Find output file
-        possible = []
-        for ext in ['.mp4', '.mkv', '.webm', '.ts']:
-            p = Path(output_path + ext)
-            if p.exists() and p.stat().st_size > 10240:
-                possible.append(p)
-        
-        for file in DOWNLOAD_DIR.glob(f"temp_{user_id}_*"):
-            if file.is_file() and file.stat().st_size > 10240:
-                possible.append(file)
-        
-        if not possible:
-            logger.error(f"No output file found for {output_path}")
+        if not output_file or not os.path.exists(output_file):
+            logger.error(f"No output file found in {workdir}")
             return None
         
-        output_file = max(possible, key=lambda p: p.stat().st_size)
-        final_path = DOWNLOAD_DIR / filename
-        
-        if output_file != final_path:
-            os.rename(output_file, final_path)
-        else:
-            final_path = output_file
+        final_path = workdir / filename
+        os.replace(output_file, final_path)
         
-        if final_path.exists() and final_path.stat().st_size > 10240:
+        if final_path.stat().st_size > 10240:
             return str(final_path)
         return None
         
+    except (asyncio.CancelledError, HostUnavailable):
+        progress_task.cancel()
+        download_progress.pop(user_id, None)
+        raise
     except Exception as e:
         logger.error(f"Video download error: {e}")
         if user_id in download_progress:
@@ -347,6 +2288,501 @@ async def download_video(url: str, quality: str, filename: str, progress_msg: Me
         return None
 
 
+async def discard_after(worker: asyncio.Future, workdir: Path):
+    """Remove a cancelled worker's scratch directory once it has let go of it"""
+    try:
+        await worker
+    except BaseException:
+        pass
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Pre-flight probing of parsed links before a batch starts
+PREFLIGHT_CONCURRENCY = int(os.getenv("PREFLIGHT_CONCURRENCY", "16"))
+PREFLIGHT_TIMEOUT = aiohttp.ClientTimeout(total=20)
+EST_THROUGHPUT = float(os.getenv("EST_THROUGHPUT_MBPS", "5")) * 1024 * 1024
+
+EXTINF_RE = re.compile(r'^#EXTINF:([\d.]+)', re.MULTILINE)
+
+
+async def probe_direct(url: str) -> dict:
+    """HEAD, falling back to a one-byte ranged GET when HEAD is refused or sizeless"""
+    async with host_request('HEAD', url, allow_redirects=True, timeout=PREFLIGHT_TIMEOUT) as response:
+        status = response.status
+        size = int(response.headers.get('content-length', 0)) or None
+        content_type = response.headers.get('content-type', '')
+    
+    if status in (403, 405, 501) or (status < 400 and not size):
+        headers = {'Range': 'bytes=0-0'}
+        async with host_request('GET', url, headers=headers, timeout=PREFLIGHT_TIMEOUT) as response:
+            status = response.status
+            content_type = response.headers.get('content-type', content_type)
+            content_range = response.headers.get('content-range', '')
+            if '/' in content_range and not content_range.endswith('*'):
+                size = int(content_range.rsplit('/', 1)[1])
+            elif status == 200:
+                size = int(response.headers.get('content-length', 0)) or None
+    
+    return {'ok': status < 400, 'status': status, 'size': size, 'content_type': content_type}
+
+
+async def probe_playlist(url: str) -> dict:
+    """Fetch the playlist only, estimating size from variant bandwidth and duration"""
+    async with host_request('GET', url, timeout=PREFLIGHT_TIMEOUT) as response:
+        status = response.status
+        content_type = response.headers.get('content-type', '')
+        text = await response.text(errors='replace') if status < 400 else ''
+    
+    size = None
+    if status < 400 and is_hls_url(url):
+        bandwidth = 0
+        playlist_url = url
+        if '#EXT-X-STREAM-INF' in text:
+            variants = parse_master_playlist(text, url)
+            if variants:
+                variant = pick_variant(variants, QUALITY_MAP['720p'])
+                bandwidth = variant['bandwidth']
+                playlist_url = variant['url']
+                async with host_request('GET', playlist_url, timeout=PREFLIGHT_TIMEOUT) as response:
+                    text = await response.text(errors='replace')
+        duration = sum(float(d) for d in EXTINF_RE.findall(text))
+        if bandwidth and duration:
+            size = int(bandwidth / 8 * duration)
+    
+    return {'ok': status < 400, 'status': status, 'size': size, 'content_type': content_type}
+
+
+async def probe_item(item: dict, sem: asyncio.Semaphore):
+    async with sem:
+        try:
+            path = urlparse(item['url']).path.lower()
+            if path.endswith(('.m3u8', '.mpd')):
+                result = await probe_playlist(item['url'])
+            else:
+                result = await probe_direct(item['url'])
+        except HostUnavailable as e:
+            # Says nothing about this link, it is tried when its turn comes
+            logger.info(f"Pre-flight skipped {item['url']}: {e}")
+            return
+        except Exception as e:
+            result = {'ok': False, 'status': 0, 'size': None, 'content_type': '', 'error': str(e)[:100]}
+    
+    item['probe'] = result
+    if result['ok'] and result['size']:
+        item['size'] = result['size']
+
+
+async def preflight(items: list) -> dict:
+    """Probe all items concurrently, returns totals for the summary"""
+    sem = asyncio.Semaphore(PREFLIGHT_CONCURRENCY)
+    await asyncio.gather(*(probe_item(item, sem) for item in items))
+    
+    alive = [i for i in items if i.get('probe') and i['probe']['ok']]
+    unchecked = sum(1 for i in items if not i.get('probe'))
+    return {
+        'ok': len(alive),
+        'dead': len(items) - len(alive) - unchecked,
+        'unchecked': unchecked,
+        'bytes': sum(i.get('size') or 0 for i in alive),
+        'unknown': sum(1 for i in alive if not i.get('size')),
+    }
+
+
+class CancelToken:
+    """Stop signal for one batch
+
+    cancel() interrupts every registered task right away: aiohttp streams,
+    scheduler waits, ffmpeg children (killed by run_media_tool) and uploads.
+    Worker threads poll `cancelled` from their progress hooks.
+    """
+    
+    def __init__(self):
+        self.event = threading.Event()
+        self.tasks: set = set()
+        self.cancelled_at: Optional[float] = None
+    
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+    
+    def track(self, task: asyncio.Task) -> asyncio.Task:
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        if self.cancelled:
+            task.cancel()
+        return task
+    
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled_at = time.monotonic()
+            self.event.set()
+        for task in list(self.tasks):
+            task.cancel()
+
+
+# Global job scheduler: bounded slots per resource, granted round-robin across users
+VIDEO_DOWNLOAD_SLOTS = int(os.getenv("VIDEO_DOWNLOAD_SLOTS", "3"))
+FILE_DOWNLOAD_SLOTS = int(os.getenv("FILE_DOWNLOAD_SLOTS", "6"))
+UPLOAD_SLOTS = int(os.getenv("UPLOAD_SLOTS", "3"))
+
+video_executor = ThreadPoolExecutor(max_workers=VIDEO_DOWNLOAD_SLOTS, thread_name_prefix="ytdlp")
+
+# Video worker processes: yt-dlp extraction, playlist parsing and decryption
+# run outside the bot process so they never hold the GIL the event loop needs.
+# VIDEO_PROCESSES=0 keeps them on video_executor threads.
+VIDEO_PROCESSES = int(os.getenv("VIDEO_PROCESSES", str(VIDEO_DOWNLOAD_SLOTS)))
+VIDEO_CANCEL_RING = 256
+VIDEO_PROGRESS_INTERVAL = 0.5
+
+# (progress queue, cancelled job ids), inherited by worker processes
+worker_ipc = None
+
+
+def video_worker_init(progress_q, cancelled):
+    global worker_ipc
+    worker_ipc = (progress_q, cancelled)
+    # Ctrl+C is for the bot, workers are stopped through the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_video_job(job_id: int, url: str, quality: str, output_path: str, user_id: int,
+                  tuning: dict, ipc=None) -> Tuple[bool, dict, dict]:
+    """One yt-dlp job, reporting progress and polling cancel over the pool's IPC"""
+    progress_q, cancelled = ipc or worker_ipc
+    job_stats = new_download_metrics()
+    last_sent = 0.0
+    
+    def progress(p):
+        nonlocal last_sent
+        now = time.monotonic()
+        if now - last_sent >= VIDEO_PROGRESS_INTERVAL:
+            last_sent = now
+            progress_q.put((job_id, user_id, p))
+    
+    def stopped():
+        return job_id in cancelled[:]
+    
+    media = {}
+    ok = download_video_sync(url, quality, output_path, user_id, tuning, job_stats, progress, stopped, media)
+    return ok, job_stats, media
+
+
+class VideoPool:
+    """yt-dlp jobs in worker processes, progress and cancel over IPC
+
+    A worker that crashes breaks its executor: the jobs running in it fail
+    and a fresh executor takes the next ones, the bot itself carries on.
+    Workers come from a forkserver with this module preloaded, never from
+    the bot process, so a restart cannot inherit a lock some thread held.
+    Importing the module has no side effects for them: stores open on first
+    use and main() creates the download directory.
+    """
+    
+    def __init__(self, size: int):
+        self.size = size
+        self.ctx = multiprocessing.get_context('forkserver')
+        self.ctx.set_forkserver_preload(['__main__'])
+        # Created by start(), the forkserver and workers import this module too
+        self.progress_q = None
+        self.cancelled = None
+        self.cancel_pos = 0
+        self.job_ids = itertools.count(1)
+        self.running: set = set()
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.pump: Optional[threading.Thread] = None
+        self.stats = {'processes': size, 'jobs': 0, 'crashes': 0, 'cancelled': 0}
+    
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.size, mp_context=self.ctx,
+                                   initializer=video_worker_init,
+                                   initargs=(self.progress_q, self.cancelled))
+    
+    def start(self):
+        """Fork the workers, ideally before threads and sockets exist"""
+        if self.pump:
+            return
+        if self.progress_q is None:
+            self.progress_q = self.ctx.Queue()
+            self.cancelled = self.ctx.Array('q', VIDEO_CANCEL_RING, lock=False)
+        if self.size:
+            self.executor = self._new_executor()
+            # Start the forkserver now rather than on the first job
+            self.executor.submit(os.getpid).result()
+        self.pump = threading.Thread(target=self._pump, name="video-progress", daemon=True)
+        self.pump.start()
+    
+    def _pump(self):
+        while True:
+            msg = self.progress_q.get()
+            if msg is None:
+                break
+            job_id, user_id, progress = msg
+            # Late messages of finished jobs would resurrect the entry
+            if job_id in self.running:
+                download_progress[user_id] = progress
+    
+    def submit(self, url: str, quality: str, output_path: str, user_id: int,
+               tuning: dict) -> Tuple[int, asyncio.Task]:
+        self.start()
+        job_id = next(self.job_ids)
+        self.running.add(job_id)
+        self.stats['jobs'] += 1
+        return job_id, asyncio.create_task(self._run(job_id, url, quality, output_path, user_id, tuning))
+    
+    async def _run(self, job_id: int, *args) -> Tuple[bool, dict, dict]:
+        executor = self.executor
+        try:
+            if executor is None:
+                loop = asyncio.get_event_loop()
+                return await loop.run_in_executor(video_executor, run_video_job, job_id, *args,
+                                                  (self.progress_q, self.cancelled))
+            return await asyncio.wrap_future(executor.submit(run_video_job, job_id, *args))
+        except BrokenProcessPool:
+            self.stats['crashes'] += 1
+            logger.error(f"Video worker died during job {job_id}, restarting the pool")
+            if self.executor is executor:
+                self.executor = self._new_executor()
+                executor.shutdown(wait=False)
+            return False, new_download_metrics(), {}
+        finally:
+            self.running.discard(job_id)
+    
+    def cancel(self, job_id: int):
+        if job_id in self.running:
+            self.cancelled[self.cancel_pos % VIDEO_CANCEL_RING] = job_id
+            self.cancel_pos += 1
+            self.stats['cancelled'] += 1
+    
+    async def shutdown(self):
+        for job_id in list(self.running):
+            self.cancel(job_id)
+        if self.executor:
+            await asyncio.to_thread(self.executor.shutdown, wait=True, cancel_futures=True)
+            self.executor = None
+        if self.pump:
+            self.progress_q.put(None)
+            await asyncio.to_thread(self.pump.join, 5)
+            self.pump = None
+
+
+video_pool = VideoPool(VIDEO_PROCESSES)
+
+
+class FairScheduler:
+    """Fixed number of slots, waiting users are served in rotation
+
+    One large batch queues behind every other waiting user once per grant,
+    so a 3-item batch never waits for a 500-item batch to finish.
+    """
+    
+    def __init__(self, name: str, slots: int):
+        self.name = name
+        self.slots = slots
+        self.active = 0
+        self.waiting: Dict[int, deque] = OrderedDict()
+    
+    def request(self, user_id: int) -> asyncio.Future:
+        fut = asyncio.get_event_loop().create_future()
+        self.waiting.setdefault(user_id, deque()).append(fut)
+        self._grant()
+        return fut
+    
+    def release(self):
+        self.active -= 1
+        self._grant()
+    
+    def withdraw(self, user_id: int, fut: asyncio.Future):
+        """Undo a request whose waiter went away"""
+        if fut.done() and not fut.cancelled():
+            self.release()
+            return
+        fut.cancel()
+        queue = self.waiting.get(user_id)
+        if queue and fut in queue:
+            queue.remove(fut)
+            if not queue:
+                del self.waiting[user_id]
+    
+    def position(self, user_id: int) -> int:
+        """1-based turn of the user's next request, 0 if not waiting"""
+        for pos, uid in enumerate(self.waiting, 1):
+            if uid == user_id:
+                return pos
+        return 0
+    
+    def queued(self) -> int:
+        return sum(len(q) for q in self.waiting.values())
+    
+    def _grant(self):
+        while self.active < self.slots and self.waiting:
+            user_id, queue = next(iter(self.waiting.items()))
+            fut = queue.popleft()
+            # Rotate the user to the back of the line
+            del self.waiting[user_id]
+            if queue:
+                self.waiting[user_id] = queue
+            if not fut.cancelled():
+                self.active += 1
+                fut.set_result(True)
+
+
+video_scheduler = FairScheduler("video download", VIDEO_DOWNLOAD_SLOTS)
+file_scheduler = FairScheduler("file download", FILE_DOWNLOAD_SLOTS)
+upload_scheduler = FairScheduler("upload", UPLOAD_SLOTS)
+
+
+@asynccontextmanager
+async def scheduled(scheduler: FairScheduler, user_id: int, prog: Message):
+    """Hold a scheduler slot, showing the queue position while waiting"""
+    fut = scheduler.request(user_id)
+    try:
+        shown = None
+        while not fut.done():
+            pos = scheduler.position(user_id)
+            if pos != shown:
+                shown = pos
+                progress_renderer.update(
+                    prog,
+                    f"⏳ Waiting for a free {scheduler.name} slot...\n\n"
+                    f"Queue position: {pos}"
+                )
+            await asyncio.wait([fut], timeout=10)
+    except BaseException:
+        scheduler.withdraw(user_id, fut)
+        raise
+    
+    try:
+        yield
+    finally:
+        scheduler.release()
+
+
+# Disk budget: admission control and orphan cleanup for DOWNLOAD_DIR
+DISK_LOW_WATERMARK = int(os.getenv("DISK_LOW_WATERMARK_MB", "512")) * 1024 * 1024
+VIDEO_SIZE_ESTIMATE = int(os.getenv("VIDEO_SIZE_ESTIMATE_MB", "400")) * 1024 * 1024
+FILE_SIZE_ESTIMATE = int(os.getenv("FILE_SIZE_ESTIMATE_MB", "20")) * 1024 * 1024
+ORPHAN_MAX_AGE = int(os.getenv("ORPHAN_MAX_AGE_MIN", "180")) * 60
+
+
+class DiskBudget:
+    """Reserves space per job so concurrent downloads can't fill the disk
+
+    A job is admitted once free space minus the reservations of running
+    jobs stays above the low watermark. Reservations start at an estimate
+    and are corrected when the real size is known. They are per process:
+    workers sharing a disk only see each other through its free space.
+    """
+    
+    def __init__(self, path: Path, low_watermark: int):
+        self.path = path
+        self.low_watermark = low_watermark
+        self.reservations: Dict[int, int] = {}
+        self.released: Optional[asyncio.Event] = None
+    
+    def free_bytes(self) -> int:
+        return shutil.disk_usage(self.path).free
+    
+    def available(self) -> int:
+        return self.free_bytes() - sum(self.reservations.values()) - self.low_watermark
+    
+    async def reserve(self, job_id: int, estimate: int, prog: Optional[Message] = None):
+        """Wait until estimate bytes fit, then hold them for job_id"""
+        evicted = False
+        while self.reservations and self.available() < estimate:
+            if not evicted:
+                evict_orphans()
+                evicted = True
+                continue
+            if prog:
+                progress_renderer.update(
+                    prog,
+                    f"💾 Waiting for disk space...\n\n"
+                    f"Free: {self.free_bytes()/(1024*1024):.0f}MB, "
+                    f"reserved by running jobs: {sum(self.reservations.values())/(1024*1024):.0f}MB"
+                )
+            self.released = self.released or asyncio.Event()
+            try:
+                await asyncio.wait_for(self.released.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                pass
+        
+        # With no other job holding space nothing would free up by waiting, so admit
+        self.reservations[job_id] = estimate
+    
+    def update(self, job_id: int, nbytes: int):
+        if job_id in self.reservations and nbytes > 0:
+            self.reservations[job_id] = nbytes
+    
+    def release(self, job_id: int):
+        self.reservations.pop(job_id, None)
+        if self.released:
+            self.released.set()
+            self.released = None
+    
+    def is_low(self) -> bool:
+        return self.free_bytes() < self.low_watermark
+    
+    def usage(self) -> dict:
+        used, _ = tree_stats(self.path)
+        return {
+            'free_mb': round(self.free_bytes() / (1024 * 1024), 1),
+            'downloads_mb': round(used / (1024 * 1024), 1),
+            'reserved_mb': round(sum(self.reservations.values()) / (1024 * 1024), 1),
+            'jobs': len(self.reservations),
+        }
+
+
+disk_budget = DiskBudget(DOWNLOAD_DIR, DISK_LOW_WATERMARK)
+
+
+def tree_stats(path: Union[str, Path]) -> Tuple[int, float]:
+    """Total bytes and newest mtime of the files under path"""
+    size, newest = 0, os.stat(path).st_mtime
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            size += st.st_size
+            newest = max(newest, st.st_mtime)
+    return size, newest
+
+
+def evict_orphans(max_age: int = ORPHAN_MAX_AGE) -> int:
+    """Delete temp files and batch directories nobody has touched for max_age seconds"""
+    cutoff = time.time() - max_age
+    freed = 0
+    for entry in os.scandir(DOWNLOAD_DIR):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                if Path(entry.path) in active_workdirs:
+                    continue
+                size, newest = tree_stats(entry.path)
+                if newest < cutoff:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    freed += size
+                continue
+            st = entry.stat(follow_symlinks=False)
+            if entry.is_file(follow_symlinks=False) and st.st_mtime < cutoff:
+                os.remove(entry.path)
+                freed += st.st_size
+        except FileNotFoundError:
+            pass
+    if freed:
+        logger.info(f"Evicted {freed/(1024*1024):.1f}MB of orphaned temp files")
+    return freed
+
+
+async def disk_janitor():
+    while True:
+        await asyncio.sleep(600)
+        try:
+            evict_orphans()
+        except Exception as e:
+            logger.error(f"Orphan cleanup error: {e}")
+
+
 @app.on_message(filters.command("start"))
 async def start_cmd(client: Client, message: Message):
     await message.reply_text(
@@ -365,6 +2801,53 @@ async def start_cmd(client: Client, message: Message):
     )
 
 
+STOP_KB = InlineKeyboardMarkup([[InlineKeyboardButton("⛔ Stop", callback_data="stop")]])
+
+
+def content_keyboard(with_check: bool) -> InlineKeyboardMarkup:
+    rows = [
+        [InlineKeyboardButton("📊 Select Range", callback_data="select_range")],
+        [InlineKeyboardButton("⬇️ Download All", callback_data="download_all")]
+    ]
+    if with_check:
+        rows.append([InlineKeyboardButton("🔍 Check Links First", callback_data="preflight")])
+    return InlineKeyboardMarkup(rows)
+
+
+def content_summary(items: list, checked: Optional[dict] = None) -> str:
+    # Count by type
+    type_counts = {}
+    for item in items:
+        ftype = item['type']
+        type_counts[ftype] = type_counts.get(ftype, 0) + 1
+    
+    type_info = "\n".join([f"{'🎬' if t == 'video' else '🖼️' if t == 'image' else '📄'} {t.title()}s: {c}" 
+                            for t, c in type_counts.items()])
+    
+    check_info = ""
+    if checked:
+        est_mb = checked['bytes'] / (1024 * 1024)
+        est_min = checked['bytes'] / EST_THROUGHPUT / 60
+        unknown = f" (+{checked['unknown']} unknown)" if checked['unknown'] else ""
+        unchecked = f"❔ Host unavailable, tried later: {checked['unchecked']}\n" if checked['unchecked'] else ""
+        check_info = (
+            f"\n🔍 **Link check:**\n"
+            f"✔️ Reachable: {checked['ok']}\n"
+            f"💀 Dead (will be skipped): {checked['dead']}\n"
+            f"{unchecked}"
+            f"💾 Est. size: {est_mb:.0f}MB{unknown}\n"
+            f"⏱️ Est. time: ~{est_min:.0f} min\n"
+        )
+    
+    return (
+        f"✅ **Content Detected:**\n\n"
+        f"{type_info}\n"
+        f"📦 Total: {len(items)}\n"
+        f"{check_info}\n"
+        f"Choose an option:"
+    )
+
+
 @app.on_message(filters.document)
 async def handle_doc(client: Client, message: Message):
     user_id = message.from_user.id
@@ -379,45 +2862,37 @@ async def handle_doc(client: Client, message: Message):
     try:
         file_path = await message.download(file_name=f"{DOWNLOAD_DIR}/{user_id}_{file_name}")
         
-        async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
-            content = await f.read()
-        
-        items = parse_content(content)
+        items = [item async for item in iter_links(file_path)]
         
         if not items:
             await status.edit_text("❌ No supported links found!")
             os.remove(file_path)
             return
         
-        # Count by type
-        type_counts = {}
-        for item in items:
-            ftype = item['type']
-            type_counts[ftype] = type_counts.get(ftype, 0) + 1
-        
         user_data[user_id] = {'items': items, 'file_path': file_path}
         
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("📊 Select Range", callback_data="select_range")],
-            [InlineKeyboardButton("⬇️ Download All", callback_data="download_all")]
-        ])
-        
-        type_info = "\n".join([f"{'🎬' if t == 'video' else '🖼️' if t == 'image' else '📄'} {t.title()}s: {c}" 
-                                for t, c in type_counts.items()])
-        
-        await status.edit_text(
-            f"✅ **Content Detected:**\n\n"
-            f"{type_info}\n"
-            f"📦 Total: {len(items)}\n\n"
-            f"Choose an option:",
-            reply_markup=kb
-        )
+        await status.edit_text(content_summary(items), reply_markup=content_keyboard(True))
         
     except Exception as e:
         logger.error(f"Document processing error: {e}")
         await status.edit_text(f"❌ Error: {str(e)[:100]}")
 
 
+@app.on_callback_query(filters.regex(r"^preflight$"))
+async def preflight_cb(client: Client, callback: CallbackQuery):
+    user_id = callback.from_user.id
+    
+    if user_id not in user_data:
+        await callback.answer("❌ Session expired!", show_alert=True)
+        return
+    
+    items = user_data[user_id]['items']
+    await callback.message.edit_text(f"🔍 Checking {len(items)} links...")
+    
+    checked = await preflight(items)
+    await callback.message.edit_text(content_summary(items, checked), reply_markup=content_keyboard(False))
+
+
 @app.on_callback_query(filters.regex(r"^(select_range|download_all)$"))
 async def range_select(client: Client, callback: CallbackQuery):
     user_id = callback.from_user.id
@@ -519,6 +2994,503 @@ async def handle_range(client: Client, message: Message):
         )
 
 
+async def fetch_item(item: dict, idx: int, quality: str, prog: Message, user_id: int,
+                     info: Optional[dict] = None, workdir: Optional[Path] = None) -> Union[str, io.BytesIO, None]:
+    """Download one batch item into workdir, returns local path or in-memory buffer"""
+    if workdir:
+        workdir.mkdir(parents=True, exist_ok=True)
+    
+    if item['type'] == 'video':
+        q_val = QUALITY_MAP[quality]
+        safe = re.sub(r'[^\w\s-]', '', item['title'])[:30]
+        fname = f"{safe}_{idx}.mp4"
+        async with scheduled(video_scheduler, user_id, prog):
+            await disk_budget.reserve(user_id, item.get('size') or VIDEO_SIZE_ESTIMATE, prog)
+            try:
+                with metrics.timer('download', 'video'):
+                    return await download_video(item['url'], q_val, fname, prog, user_id, info, workdir)
+            finally:
+                disk_budget.release(user_id)
+    
+    safe = re.sub(r'[^\w\s-]', '', item['title'])[:50]
+    default_ext = '.jpg' if item['type'] == 'image' else '.pdf'
+    ext = os.path.splitext(item['url'])[1] or default_ext
+    fname = f"{safe}_{idx}{ext}"
+    async with scheduled(file_scheduler, user_id, prog):
+        await disk_budget.reserve(user_id, item.get('size') or FILE_SIZE_ESTIMATE, prog)
+        try:
+            with metrics.timer('download', item['type']):
+                return await download_file(item['url'], fname, prog, user_id, workdir)
+        finally:
+            disk_budget.release(user_id)
+
+
+async def fetch_job(idx: int, item: dict, prog: Message, quality: str, user_id: int,
+                    workdir: Path, batch_keys: set, defer: bool) -> Optional[dict]:
+    """Resolve one item to a job for the process stage
+
+    Returns None when the item's host is down and defer is set, the caller
+    queues it again after the rest of the batch.
+    """
+    key = cache_key(item, quality)
+    job = {'idx': idx, 'item': item, 'prog': prog, 'path': None, 'error': False, 'key': key}
+    
+    job['cached'] = media_cache.get(key)
+    if job['cached']:
+        cache_stats['hits'] += 1
+    elif item.get('probe') and not item['probe']['ok']:
+        # Dead at pre-flight, fail fast instead of burning retries
+        job['reason'] = "link unreachable"
+    elif key in batch_keys:
+        # Same link earlier in this batch, resolved from the cache at upload time
+        # or fetched then if the first copy left nothing there
+        job['duplicate'] = True
+    else:
+        batch_keys.add(key)
+        try:
+            job['info'] = {}
+            path = await fetch_item(item, idx, quality, prog, user_id, job['info'], workdir / f"item_{idx}")
+            if isinstance(path, io.BytesIO) or (path and os.path.exists(path)):
+                job['path'] = path
+                metrics.inc('downloaded_bytes_total', payload_size(path), type=item['type'])
+        except HostUnavailable as e:
+            if defer:
+                batch_keys.discard(key)
+                logger.info(f"Item {idx} deferred: {e}")
+                progress_renderer.update(prog, f"📦 **Item {idx}**\n⏭️ Host is down, moved to the end of the batch")
+                return None
+            job['error'] = True
+            job['reason'] = "host unavailable"
+        except Exception as e:
+            logger.error(f"Item {idx} download error: {e}")
+            job['error'] = True
+        cache_stats['misses'] += 1
+        
+        if not job['path'] and disk_budget.is_low():
+            job['reason'] = "out of disk space"
+    return job
+
+
+async def put_job(out_q: asyncio.Queue, job: dict):
+    try:
+        await out_q.put(job)
+    except asyncio.CancelledError:
+        discard_job_files(job)
+        raise
+
+
+async def fetch_stage(selected_items: list, start: int, end: int, quality: str,
+                      chat_msg: Message, user_id: int, out_q: asyncio.Queue, workdir: Path,
+                      done: Optional[set] = None):
+    """Stage 1: download items in serial order, at most PREFETCH_DEPTH ahead of upload
+
+    With DEFER_DEAD_HOSTS, items whose host has an open circuit go to the
+    end of the batch and get one more try once the host's cooldown has run
+    out. That delivers them out of serial order, so it is off by default. Indices in done were
+    delivered before a restart and are skipped.
+    """
+    batch_keys = set()
+    deferred = []
+    
+    for idx, item in enumerate(selected_items, start):
+        if not active_downloads.get(user_id, False):
+            break
+        if done and idx in done:
+            continue
+        
+        # Serial number in progress
+        prog = await chat_msg.reply_text(
+            f"📦 **Item {idx}/{end}**\n"
+            f"📝 {item['title'][:50]}..."
+        )
+        
+        job = await fetch_job(idx, item, prog, quality, user_id, workdir, batch_keys, DEFER_DEAD_HOSTS)
+        if job is None:
+            deferred.append((idx, item, prog))
+            continue
+        await put_job(out_q, job)
+    
+    # One cooldown wait per host: if its trial fails the circuit reopens and
+    # the host's remaining items fail fast instead of waiting again
+    waited = set()
+    for n, (idx, item, prog) in enumerate(deferred):
+        if not active_downloads.get(user_id, False):
+            for _, _, left in deferred[n:]:
+                await progress_renderer.delete(left)
+            break
+        host = urlparse(item['url']).hostname or ''
+        wait = 0 if host in waited else host_guard.cooldown_left(host)
+        waited.add(host)
+        if wait > 0:
+            progress_renderer.update(prog, f"📦 **Item {idx}**\n⏳ Waiting {wait:.0f}s for the host to recover...")
+            await asyncio.sleep(wait)
+        job = await fetch_job(idx, item, prog, quality, user_id, workdir, batch_keys, False)
+        await put_job(out_q, job)
+    
+    await out_q.put(None)
+
+
+async def analyze_video(job: dict, user_id: int):
+    """Duration, dimensions and thumbnail with as little reading as possible
+
+    What yt-dlp reported is used as is, ffprobe only runs when something is
+    missing and then alongside the thumbnail, which seeks before decoding.
+    """
+    known = job.get('info') or {}
+    part = f"_{job['part'][0]}" if job.get('part') else ''
+    thumb_path = os.path.join(os.path.dirname(job['path']), f"thumb{part}.jpg")
+    seek = min(THUMB_SEEK, known['duration'] / 2) if known.get('duration') else THUMB_SEEK
+    
+    async def probe() -> dict:
+        if all(known.get(k) for k in ('duration', 'width', 'height')):
+            return {'duration': int(known['duration']), 'width': known['width'], 'height': known['height']}
+        with metrics.timer('probe', 'video'):
+            return await get_video_info(job['path'])
+    
+    async def thumbnail(at: float) -> bool:
+        with metrics.timer('thumbnail', 'video'):
+            return await generate_thumbnail(job['path'], thumb_path, at)
+    
+    job['info'], thumb_ok = await asyncio.gather(probe(), thumbnail(seek))
+    if not thumb_ok and seek and job['info']['duration'] < seek:
+        # Clip shorter than the guessed seek point
+        thumb_ok = await thumbnail(0)
+    if thumb_ok:
+        job['thumb'] = thumb_path
+
+
+async def split_video(job: dict, user_id: int, out_q: asyncio.Queue) -> bool:
+    """Queue an oversize video as parts under UPLOAD_LIMIT, each as soon as it is cut
+
+    Returns False, queueing nothing, when no cut points could be found.
+    """
+    src = job['path']
+    with metrics.timer('split', 'video'):
+        cuts = await plan_cuts(src, UPLOAD_LIMIT)
+    if not cuts:
+        return False
+    
+    bounds = list(zip([0.0] + cuts, cuts + [None]))
+    total = len(bounds)
+    split = {}
+    base = os.path.splitext(src)[0]
+    logger.info(f"Item {job['idx']}: {os.path.getsize(src)/(1024*1024):.0f}MB, splitting into {total} parts")
+    
+    try:
+        for n, (start, end) in enumerate(bounds, 1):
+            part_job = dict(job, path=None, info=None, thumb=None, key=None,
+                            part=(n, total), split=split, last=n == total)
+            progress_renderer.update(job['prog'], f"✂️ Splitting video: part {n}/{total}...")
+            
+            part_path = f"{base}.part{n}.mp4"
+            if not await cut_part(src, part_path, start, end):
+                # Parts already queued still go out, the item counts as failed
+                part_job.update(error=True, last=True)
+                await out_q.put(part_job)
+                break
+            
+            part_job['path'] = part_path
+            try:
+                await analyze_video(part_job, user_id)
+            except asyncio.CancelledError:
+                discard_job_files(part_job)
+                raise
+            except Exception as e:
+                # Like a whole video, the part still goes out without the metadata
+                logger.error(f"Item {job['idx']} part {n} processing error: {e}")
+            await put_job(out_q, part_job)
+    finally:
+        discard_job_files({'path': src})
+    return True
+
+
+async def process_stage(user_id: int, in_q: asyncio.Queue, out_q: asyncio.Queue):
+    """Stage 2: ffprobe and thumbnail for downloaded videos, oversize ones are split"""
+    while True:
+        job = await in_q.get()
+        if job is None:
+            break
+        
+        try:
+            if job['item']['type'] == 'video' and job['path'] and active_downloads.get(user_id, False):
+                progress_renderer.update(job['prog'], "🎬 Processing video...")
+                if os.path.getsize(job['path']) > UPLOAD_LIMIT:
+                    try:
+                        if await split_video(job, user_id, out_q):
+                            continue
+                    except Exception as e:
+                        logger.error(f"Item {job['idx']} split error: {e!r}")
+                    # Sent whole it would only be rejected after the full upload
+                    discard_job_files(job)
+                    job.update(path=None, thumb=None, reason="could not split")
+                else:
+                    try:
+                        await analyze_video(job, user_id)
+                    except Exception as e:
+                        logger.error(f"Item {job['idx']} processing error: {e}")
+            
+            await out_q.put(job)
+        except asyncio.CancelledError:
+            # Job is in neither queue, so drain_queue will not see it
+            discard_job_files(job)
+            raise
+    
+    await out_q.put(None)
+
+
+def job_caption(job: dict) -> str:
+    caption = f"{job['idx']}. {job['item']['title']}"
+    if job.get('part'):
+        caption += f" (part {job['part'][0]}/{job['part'][1]})"
+    return caption
+
+
+async def upload_item(job: dict, quality: str, chat_msg: Message) -> Message:
+    """Send one processed item to the chat, from disk or by cached file_id"""
+    item = job['item']
+    serial_caption = job_caption(job)
+    cached = job.get('cached')
+    
+    if cached:
+        kind = cached['kind']
+        source = cached['file_id']
+        meta = cached['meta']
+    else:
+        kind = {'image': 'photo'}.get(item['type'], item['type'])
+        source = job['path']
+        size = payload_size(source)
+        meta = {'size_mb': size / (1024 * 1024)}
+        if item['type'] == 'video':
+            meta.update(job.get('info') or {'duration': 0, 'width': 1280, 'height': 720})
+    
+    if item['type'] == 'video':
+        caption = f"🎬 {serial_caption}\n📊 {quality} | 💾 {meta['size_mb']:.1f}MB"
+    elif item['type'] == 'image':
+        caption = f"🖼️ {serial_caption}"
+    else:
+        caption = f"📄 {serial_caption}"
+    
+    with metrics.timer('resend' if cached else 'upload', item['type']):
+        sent = await send_media(kind, source, caption, meta, job, chat_msg)
+    
+    if not cached and sent:
+        metrics.inc('uploaded_bytes_total', size, type=item['type'])
+        sent_kind, file_id = sent_media(sent)
+        # A part is not the whole item, split videos are not cached
+        if file_id and not job.get('part'):
+            media_cache.put(job['key'], sent_kind, file_id, meta)
+    return sent
+
+
+async def upload_progress(current: int, total: int, prog: Message, started: float):
+    elapsed = time.monotonic() - started
+    speed = current / elapsed if elapsed > 0 else 0
+    progress_renderer.update(
+        prog,
+        f"📤 Uploading...\n\n"
+        f"Progress: {current / total * 100:.1f}%\n"
+        f"Size: {current/(1024*1024):.1f}MB / {total/(1024*1024):.1f}MB\n"
+        f"Speed: {speed/(1024*1024):.2f} MB/s"
+    )
+
+
+async def send_media(kind: str, source, caption: str, meta: dict, job: dict, chat_msg: Message) -> Message:
+    if kind == 'video':
+        progress_renderer.update(job['prog'], "📤 Uploading...")
+        sent = await chat_msg.reply_video(
+            source,
+            caption=caption,
+            supports_streaming=True,
+            duration=int(meta.get('duration', 0)),
+            width=meta.get('width', 1280),
+            height=meta.get('height', 720),
+            thumb=job.get('thumb'),
+            progress=upload_progress,
+            progress_args=(job['prog'], time.monotonic())
+        )
+    elif kind == 'animation':
+        progress_renderer.update(job['prog'], "📤 Uploading...")
+        sent = await chat_msg.reply_animation(
+            source,
+            caption=caption
+        )
+    elif kind == 'photo':
+        progress_renderer.update(job['prog'], "📤 Uploading image...")
+        sent = await chat_msg.reply_photo(
+            source,
+            caption=caption
+        )
+    else:
+        progress_renderer.update(job['prog'], "📤 Uploading document...")
+        sent = await chat_msg.reply_document(
+            source,
+            caption=caption,
+            progress=upload_progress,
+            progress_args=(job['prog'], time.monotonic())
+        )
+    return sent
+
+
+def discard_job_files(job: dict):
+    for p in (job.get('path'), job.get('thumb')):
+        if isinstance(p, str):
+            try:
+                os.remove(p)
+            except:
+                pass
+
+
+async def refetch_job(job: dict, quality: str, user_id: int, workdir: Path) -> list:
+    """Fetch and process an item the cache could not serve after all
+
+    Returns the jobs ready for upload, the parts if the video had to be split.
+    """
+    fresh = await fetch_job(job['idx'], job['item'], job['prog'], quality, user_id, workdir, set(), False)
+    fresh['refetched'] = True
+    fetched, ready = asyncio.Queue(), asyncio.Queue()
+    fetched.put_nowait(fresh)
+    fetched.put_nowait(None)
+    jobs = []
+    try:
+        await process_stage(user_id, fetched, ready)
+        while (part := ready.get_nowait()) is not None:
+            jobs.append(part)
+    except asyncio.CancelledError:
+        for part in jobs:
+            discard_job_files(part)
+        raise
+    finally:
+        await drain_queue(ready)
+    return jobs
+
+
+async def upload_stage(quality: str, chat_msg: Message, user_id: int,
+                       in_q: asyncio.Queue, stats: dict, workdir: Path):
+    """Stage 3: upload in serial order, one item at a time
+
+    A duplicate whose first copy left no cache entry, or a cached file_id
+    the server rejects, goes through fetch and process here once more.
+    """
+    while True:
+        job = await in_q.get()
+        if job is None:
+            break
+        
+        jobs = [job]
+        try:
+            while jobs:
+                job = jobs.pop(0)
+                if job.get('duplicate'):
+                    job['cached'] = media_cache.get(job['key'])
+                    if job['cached']:
+                        cache_stats['hits'] += 1
+                
+                if job.get('duplicate') and not job['cached'] and active_downloads.get(user_id, False):
+                    logger.info(f"Item {job['idx']}: first copy not cached, fetching it")
+                    jobs[:0] = await refetch_job(job, quality, user_id, workdir)
+                elif await deliver_job(job, quality, chat_msg, user_id, stats):
+                    logger.info(f"Item {job['idx']}: cached file_id rejected, fetching it again")
+                    jobs[:0] = await refetch_job(job, quality, user_id, workdir)
+        except asyncio.CancelledError:
+            for left in jobs:
+                discard_job_files(left)
+            raise
+
+
+async def deliver_job(job: dict, quality: str, chat_msg: Message, user_id: int, stats: dict) -> bool:
+    """Upload or report one job and settle its outcome
+
+    Returns True, without settling, when a cached send failed and the item
+    has not been fetched again yet, the caller fetches it instead.
+    """
+    idx = job['idx']
+    item = job['item']
+    serial_caption = job_caption(job)
+    
+    try:
+        if not active_downloads.get(user_id, False):
+            # Stopped while this item was queued, drop it
+            await progress_renderer.delete(job['prog'])
+            count_item(job, 'stopped', 'user')
+        elif job['error']:
+            progress_renderer.update(job['prog'], "❌ Error occurred")
+            await chat_msg.reply_text(
+                f"❌ Failed to process:\n\n{serial_caption}\n\n🔗 Link: {item['url']}"
+            )
+            await settle_item(job, user_id, stats, 'failed', 'download error')
+        elif job['path'] or job.get('cached'):
+            async with scheduled(upload_scheduler, user_id, job['prog']):
+                await upload_item(job, quality, chat_msg)
+            if await settle_item(job, user_id, stats, 'success', 'cached' if job.get('cached') else 'downloaded'):
+                await progress_renderer.delete(job['prog'])
+        else:
+            # Fallback: send link if download fails
+            reason = f" ({job['reason']})" if job.get('reason') else ""
+            await chat_msg.reply_text(
+                f"❌ Download failed{reason} for:\n\n{serial_caption}\n\n🔗 Link: {item['url']}"
+            )
+            await settle_item(job, user_id, stats, 'failed', job.get('reason') or 'download failed')
+            await progress_renderer.delete(job['prog'])
+    
+    except Exception as e:
+        logger.error(f"Item {idx} error: {e}")
+        if job.get('cached'):
+            # Stale file_id, drop it and download the item instead
+            media_cache.delete(job['key'])
+            if not job.get('refetched') and active_downloads.get(user_id, False):
+                return True
+        try:
+            progress_renderer.update(job['prog'], "❌ Error occurred")
+            await chat_msg.reply_text(
+                f"❌ Failed to process:\n\n{serial_caption}\n\n🔗 Link: {item['url']}"
+            )
+        except Exception as notice_error:
+            logger.warning(f"Item {idx} failure notice error: {notice_error}")
+        await settle_item(job, user_id, stats, 'failed', 'upload error')
+    finally:
+        discard_job_files(job)
+    return False
+
+
+async def settle_item(job: dict, user_id: int, stats: dict, result: str, reason: str) -> bool:
+    """Count and journal an item's outcome, for split videos after the last part
+
+    Returns whether the item is finished. A journal that cannot be written
+    only costs resume precision, the outcome itself stands.
+    """
+    split = job.get('split')
+    if split is not None:
+        if result == 'failed':
+            split.setdefault('failed', reason)
+        if not job['last']:
+            return False
+        if 'failed' in split:
+            result, reason = 'failed', split['failed']
+    
+    cached = result == 'success' and reason == 'cached'
+    stats[result] += 1
+    if cached:
+        stats['cached'] += 1
+    count_item(job, result, reason)
+    try:
+        await journal_call(journal.mark, user_id, job['idx'], 'cached' if cached else result)
+    except sqlite3.Error as e:
+        logger.error(f"Item {job['idx']} outcome not journaled, a resume would repeat it: {e}")
+    return True
+
+
+def count_item(job: dict, result: str, reason: str):
+    metrics.inc('items_total', type=job['item']['type'], result=result, reason=reason.replace(' ', '_'))
+
+
+async def drain_queue(q: asyncio.Queue):
+    """Remove files of jobs that never reached the upload stage"""
+    while not q.empty():
+        job = q.get_nowait()
+        if job is not None:
+            discard_job_files(job)
+
+
 @app.on_callback_query(filters.regex(r"^q_"))
 async def quality_cb(client: Client, callback: CallbackQuery):
     user_id = callback.from_user.id
@@ -532,198 +3504,377 @@ async def quality_cb(client: Client, callback: CallbackQuery):
     file_path = user_data[user_id]['file_path']
     start, end = user_data[user_id]['range']
     
+    try:
+        busy = await journal_call(journal.active, user_id) if ROLE == "bot" else active_downloads.get(user_id, False)
+    except sqlite3.Error as e:
+        logger.error(f"Journal unavailable: {e}")
+        await callback.answer("❌ Busy, please try again in a moment", show_alert=True)
+        return
+    if busy:
+        await callback.answer("⏳ A batch is already running!", show_alert=True)
+        return
+    
     selected_items = items[start-1:end]
+    if ROLE == "bot":
+        await queue_batch(callback.message, user_id, selected_items, start, end, quality, file_path)
+        return
+    try:
+        created = await journal_call(journal.start, user_id, callback.message.chat.id,
+                                     selected_items, start, end, quality)
+    except sqlite3.Error as e:
+        logger.error(f"Journal unavailable: {e}")
+        await callback.answer("❌ Busy, please try again in a moment", show_alert=True)
+        return
     active_downloads[user_id] = True
     
-    stop_kb = InlineKeyboardMarkup([[InlineKeyboardButton("⛔ Stop", callback_data="stop")]])
-    
     await callback.message.edit_text(
         f"🚀 **Starting batch download**\n\n"
         f"Quality: {quality}\n"
         f"Range: {start}-{end}\n"
         f"Total: {len(selected_items)} items\n\n"
         f"⏳ Processing...",
-        reply_markup=stop_kb
+        reply_markup=STOP_KB
     )
     
-    success = 0
-    failed = 0
-    
-    for idx, item in enumerate(selected_items, start):
-        if not active_downloads.get(user_id, False):
-            await callback.message.reply_text("⛔ Download stopped by user!")
-            break
-        
-        # Serial number in progress
-        prog = await callback.message.reply_text(
-            f"📦 **Item {idx}/{end}**\n"
-            f"📝 {item['title'][:50]}..."
-        )
-        
-        try:
-            # Create caption with serial number
-            serial_caption = f"{idx}. {item['title']}"
-            
-            if item['type'] == 'video':
-                q_val = QUALITY_MAP[quality]
-                safe = re.sub(r'[^\w\s-]', '', item['title'])[:30]
-                fname = f"{safe}_{idx}.mp4"
-                
-                vpath = await download_video(item['url'], q_val, fname, prog, user_id)
-                
-                if vpath and active_downloads.get(user_id, False) and os.path.exists(vpath):
-                    fsize = os.path.getsize(vpath) / (1024 * 1024)
-                    
-                    await prog.edit_text("🎬 Processing video...")
-                    video_info = get_video_info(vpath)
-                    
-                    thumb_path = str(DOWNLOAD_DIR / f"thumb_{user_id}_{idx}.jpg")
-                    has_thumb = generate_thumbnail(vpath, thumb_path)
-                    
-                    await prog.edit_text("📤 Uploading...")
-                    
-                    await callback.message.reply_video(
-                        vpath,
-                        caption=f"🎬 {serial_caption}\n📊 {quality} | 💾 {fsize:.1f}MB",
-                        supports_streaming=True,
-                        duration=video_info['duration'],
-                        width=video_info['width'],
-                        height=video_info['height'],
-                        thumb=thumb_path if has_thumb else None
-                    )
-                    
-                    os.remove(vpath)
-                    if has_thumb:
-                        try:
-                            os.remove(thumb_path)
-                        except:
-                            pass
-                    
-                    await prog.delete()
-                    success += 1
-                else:
-                    # Fallback: send link if download fails
-                    await callback.message.reply_text(
-                        f"❌ Download failed for:\n\n{serial_caption}\n\n🔗 Link: {item['url']}"
-                    )
-                    await prog.delete()
-                    failed += 1
-                    
-            elif item['type'] == 'image':
-                safe = re.sub(r'[^\w\s-]', '', item['title'])[:50]
-                ext = os.path.splitext(item['url'])[1] or '.jpg'
-                fname = f"{safe}_{idx}{ext}"
-                
-                ipath = await download_file(item['url'], fname, prog, user_id)
-                
-                if ipath and active_downloads.get(user_id, False) and os.path.exists(ipath):
-                    await prog.edit_text("📤 Uploading image...")
-                    await callback.message.reply_photo(
-                        ipath, 
-                        caption=f"🖼️ {serial_caption}"
-                    )
-                    os.remove(ipath)
-                    await prog.delete()
-                    success += 1
-                else:
-                    await callback.message.reply_text(
-                        f"❌ Download failed for:\n\n{serial_caption}\n\n🔗 Link: {item['url']}"
-                    )
-                    await prog.delete()
-                    failed += 1
-                    
-            elif item['type'] == 'document':
-                safe = re.sub(r'[^\w\s-]', '', item['title'])[:50]
-                ext = os.path.splitext(item['url'])[1] or '.pdf'
-                fname = f"{safe}_{idx}{ext}"
-                
-                dpath = await download_file(item['url'], fname, prog, user_id)
-                
-                if dpath and active_downloads.get(user_id, False) and os.path.exists(dpath):
-                    await prog.edit_text("📤 Uploading document...")
-                    await callback.message.reply_document(
-                        dpath, 
-                        caption=f"📄 {serial_caption}"
-                    )
-                    os.remove(dpath)
-                    await prog.delete()
-                    success += 1
-                else:
-                    await callback.message.reply_text(
-                        f"❌ Download failed for:\n\n{serial_caption}\n\n🔗 Link: {item['url']}"
-                    )
-                    await prog.delete()
-                    failed += 1
-        
-        except Exception as e:
-            logger.error(f"Item {idx} error: {e}")
-            try:
-                await prog.edit_text(f"❌ Error occurred")
-                await callback.message.reply_text(
-                    f"❌ Failed to process:\n\n{idx}. {item['title']}\n\n🔗 Link: {item['url']}"
-                )
-            except:
-                pass
-            failed += 1
-        
-        await asyncio.sleep(1)
-    
-    # Cleanup
+    # Run the batch beside the dispatcher, a held handler worker would stall every other update
+    task = asyncio.create_task(run_batch(callback.message, user_id, selected_items, start, end, quality,
+                                         file_path, batch_workdir(user_id, created)))
+    batch_tasks.add(task)
+    task.add_done_callback(batch_tasks.discard)
+
+
+async def queue_batch(chat_msg: Message, user_id: int, selected_items: list, start: int, end: int,
+                      quality: str, file_path: Optional[str]):
+    """ROLE=bot: leave the batch in the journal for a worker to claim"""
     try:
-        os.remove(file_path)
-    except:
-        pass
+        await journal_call(journal.start, user_id, chat_msg.chat.id, selected_items, start, end, quality)
+    except sqlite3.Error as e:
+        logger.error(f"Journal unavailable, batch for {user_id} not queued: {e}")
+        await chat_msg.edit_text("❌ Could not queue the batch, please choose the quality again")
+        return
+    logger.info(f"Queued batch for {user_id}: {len(selected_items)} items")
+    
+    await chat_msg.edit_text(
+        f"📨 **Batch queued**\n\n"
+        f"Quality: {quality}\n"
+        f"Range: {start}-{end}\n"
+        f"Total: {len(selected_items)} items\n\n"
+        f"⏳ A worker will pick it up shortly",
+        reply_markup=STOP_KB
+    )
     
-    for tf in DOWNLOAD_DIR.glob(f"temp_{user_id}_*"):
+    if file_path:
         try:
-            os.remove(tf)
+            os.remove(file_path)
         except:
             pass
+    user_data.pop(user_id, None)
+
+
+def batch_workdir(user_id: int, created: float) -> Path:
+    """Scratch directory of one batch, stable across restarts so partial downloads resume"""
+    return DOWNLOAD_DIR / f"job_{user_id}_{int(created)}"
+
+
+async def run_batch(chat_msg: Message, user_id: int, selected_items: list, start: int, end: int,
+                    quality: str, file_path: Optional[str], workdir: Path, first: Optional[int] = None,
+                    owner: Optional[str] = None):
+    """Run a journaled batch from item `first` (default start) and send the summary
+
+    Every item works in its own directory under workdir, which goes away in
+    one removal when the batch ends. owner is the claiming worker, which
+    only reports if it still holds the batch at the end.
+    """
+    first = first or start
+    try:
+        stats = await journal_call(journal.counts, user_id)
+        delivered = await journal_call(journal.done, user_id)
+    except sqlite3.Error as e:
+        # The row stays, a restart or another worker takes the batch up again
+        logger.error(f"Journal unavailable, batch for {user_id} left for resume: {e}")
+        active_downloads.pop(user_id, None)
+        await chat_msg.reply_text("⚠️ Batch paused, the job journal is unavailable. It resumes later.")
+        return
+    active_workdirs.add(workdir)
+    
+    # fetch -> process -> upload, bounded queues cap the number of
+    # finished-but-not-uploaded files on disk
+    chat_id = chat_msg.chat.id
+    edits_saved_before = progress_renderer.saved(chat_id)
+    processed_q = asyncio.Queue(maxsize=PREFETCH_DEPTH)
+    ready_q = asyncio.Queue(maxsize=PREFETCH_DEPTH)
+    
+    token = cancel_tokens[user_id] = CancelToken()
+    stages = [
+        token.track(asyncio.create_task(fetch_stage(selected_items[first - start:], first, end, quality,
+                                                    chat_msg, user_id, processed_q, workdir,
+                                                    delivered))),
+        token.track(asyncio.create_task(process_stage(user_id, processed_q, ready_q))),
+        token.track(asyncio.create_task(upload_stage(quality, chat_msg, user_id, ready_q, stats,
+                                                     workdir))),
+    ]
+    
+    broken = False
+    try:
+        # Stop cancels the stages directly, an error in one tears down the rest
+        done, pending = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*stages, return_exceptions=True)
+        for task in stages:
+            if not task.cancelled() and task.exception():
+                broken = True
+                logger.error(f"Batch pipeline error: {task.exception()}")
+    finally:
+        await drain_queue(processed_q)
+        await drain_queue(ready_q)
+        cancel_tokens.pop(user_id, None)
     
-    for tf in DOWNLOAD_DIR.glob(f"thumb_{user_id}_*"):
+    if broken and not token.cancelled:
+        # Row and partials stay for a resume from the first undelivered item
+        active_workdirs.discard(workdir)
+        user_data.pop(user_id, None)
+        active_downloads.pop(user_id, None)
+        await chat_msg.reply_text("⚠️ Batch interrupted by an error, the remaining items resume later.")
+        return
+    
+    # Stopped or complete, either way nothing left to resume. A worker that lost
+    # its lease leaves the batch and its summary to the new holder.
+    try:
+        owned = await journal_call(journal.finish, user_id, owner) or owner is None
+    except sqlite3.Error as e:
+        # A resume of the leftover row finds every item delivered and drops it
+        logger.error(f"Journal finish for {user_id} failed: {e}")
+        owned = True
+    
+    if token.cancelled and owned:
+        logger.info(f"Batch for {user_id} released {time.monotonic() - token.cancelled_at:.2f}s after stop")
+        await chat_msg.reply_text("⛔ Download stopped by user!")
+    
+    success = stats['success']
+    failed = stats['failed']
+    edits_saved = progress_renderer.saved(chat_id) - edits_saved_before
+    logger.info(f"Batch for {user_id}: {edits_saved} status edits coalesced or skipped")
+    
+    # Cleanup
+    if file_path:
         try:
-            os.remove(tf)
+            os.remove(file_path)
         except:
             pass
     
+    if owned:
+        shutil.rmtree(workdir, ignore_errors=True)
+    active_workdirs.discard(workdir)
+    
     if user_id in user_data:
         del user_data[user_id]
     if user_id in active_downloads:
         del active_downloads[user_id]
     
-    await callback.message.reply_text(
+    if not owned:
+        logger.warning(f"Batch for {user_id} was taken over by another worker")
+        return
+    
+    await chat_msg.reply_text(
         f"✅ **Batch Complete!**\n\n"
         f"✔️ Success: {success}\n"
         f"❌ Failed: {failed}\n"
+        f"♻️ From cache: {stats['cached']}\n"
         f"📊 Total: {len(selected_items)}\n\n"
         f"🎯 Range was: {start}-{end}"
     )
 
 
+async def resume_batches():
+    """Restart batches a restart interrupted, from their first undelivered item"""
+    for batch in journal.unfinished():
+        user_id = batch['user_id']
+        start, end, first = batch['start'], batch['end'], batch['first']
+        if first > end or active_downloads.get(user_id, False):
+            journal.finish(user_id)
+            continue
+        
+        try:
+            chat_msg = await app.send_message(
+                batch['chat_id'],
+                f"♻️ **Bot restarted, resuming your batch**\n\n"
+                f"Quality: {batch['quality']}\n"
+                f"Range: {start}-{end}\n"
+                f"Continuing from item {first}, {first - start} already delivered",
+                reply_markup=STOP_KB
+            )
+        except Exception as e:
+            logger.error(f"Resume notice for {user_id} failed, dropping batch: {e}")
+            journal.finish(user_id)
+            continue
+        
+        logger.info(f"Resuming batch for {user_id} at item {first}/{end}")
+        active_downloads[user_id] = True
+        task = asyncio.create_task(run_batch(chat_msg, user_id, batch['items'], start, end, batch['quality'],
+                                             None, batch_workdir(user_id, batch['created']), first))
+        batch_tasks.add(task)
+        task.add_done_callback(batch_tasks.discard)
+
+
+async def run_claimed(batch: dict):
+    """ROLE=worker: run a batch claimed from the journal, progress goes straight to the chat"""
+    user_id = batch['user_id']
+    start, end, first = batch['start'], batch['end'], batch['first']
+    if first > end:
+        await journal_call(journal.finish, user_id, WORKER_ID)
+        return
+    
+    try:
+        chat_msg = await app.send_message(
+            batch['chat_id'],
+            f"⚙️ **Batch started on {WORKER_ID}**\n\n"
+            f"Quality: {batch['quality']}\n"
+            f"Range: {start}-{end}\n"
+            f"Continuing from item {first}, {first - start} already delivered",
+            reply_markup=STOP_KB
+        )
+    except Exception as e:
+        logger.error(f"Start notice for {user_id} failed, dropping batch: {e}")
+        await journal_call(journal.finish, user_id, WORKER_ID)
+        return
+    
+    active_downloads[user_id] = True
+    await run_batch(chat_msg, user_id, batch['items'], start, end, batch['quality'], None,
+                    batch_workdir(user_id, batch['created']), first, WORKER_ID)
+
+
+async def worker_heartbeat(running: Dict[int, asyncio.Task]):
+    """Keep this worker's leases alive and apply stops the bot recorded"""
+    while True:
+        await asyncio.sleep(WORKER_HEARTBEAT)
+        try:
+            held = await journal_call(journal.heartbeat, WORKER_ID, list(running))
+        except Exception as e:
+            # Retried next beat, the lease outlasts several misses
+            logger.error(f"Worker heartbeat failed: {e}")
+            continue
+        for user_id in list(running):
+            if user_id not in cancel_tokens or not active_downloads.get(user_id, False):
+                continue
+            if user_id not in held:
+                logger.warning(f"Lease on batch {user_id} lost, stopping it here")
+                request_stop(user_id)
+            elif held[user_id]:
+                request_stop(user_id)
+
+
+async def worker_loop():
+    """ROLE=worker: claim batches from the journal, WORKER_BATCHES at a time"""
+    running: Dict[int, asyncio.Task] = {}
+    beat = asyncio.create_task(worker_heartbeat(running))
+    logger.info(f"Worker {WORKER_ID} polling {JOURNAL_PATH}")
+    try:
+        while True:
+            batch = None
+            if len(running) < WORKER_BATCHES:
+                try:
+                    batch = await journal_call(journal.claim, WORKER_ID, WORKER_LEASE)
+                except Exception as e:
+                    logger.error(f"Batch claim failed: {e}")
+            if batch is None:
+                await asyncio.sleep(WORKER_POLL)
+                continue
+            user_id = batch['user_id']
+            logger.info(f"Claimed batch for {user_id} at item {batch['first']}/{batch['end']}")
+            task = running[user_id] = asyncio.create_task(run_claimed(batch))
+            task.add_done_callback(lambda t, u=user_id: running.pop(u, None))
+    finally:
+        beat.cancel()
+        tasks = list(running.values())
+        stages = [stage for u in running if u in cancel_tokens for stage in cancel_tokens[u].tasks]
+        # run_batch first, so it is interrupted before it could finish the journal row
+        for task in tasks + stages:
+            task.cancel()
+        await asyncio.gather(beat, *tasks, *stages, return_exceptions=True)
+        # Partials stay here, but another worker need not wait out the lease
+        try:
+            await journal_call(journal.release, WORKER_ID)
+        except Exception as e:
+            logger.error(f"Lease release failed, batches return after {WORKER_LEASE:.0f}s: {e}")
+
+
+async def stop_batch(user_id: int):
+    """Stop button and /cancel: stop here, or flag the row for the worker running it"""
+    if ROLE != "bot":
+        request_stop(user_id)
+        return
+    # The worker sees the flag at its next heartbeat
+    try:
+        await journal_call(journal.request_stop, user_id)
+    except sqlite3.Error as e:
+        logger.error(f"Stop for {user_id} not recorded: {e}")
+
+
+def request_stop(user_id: int):
+    active_downloads[user_id] = False
+    token = cancel_tokens.get(user_id)
+    if token:
+        token.cancel()
+
+
 @app.on_callback_query(filters.regex("^stop$"))
 async def stop_cb(client: Client, callback: CallbackQuery):
     user_id = callback.from_user.id
-    active_downloads[user_id] = False
+    await stop_batch(user_id)
     await callback.answer("⛔ Stopping downloads...", show_alert=True)
 
 
 @app.on_message(filters.command("cancel"))
 async def cancel_cmd(client: Client, message: Message):
-    active_downloads[message.from_user.id] = False
+    await stop_batch(message.from_user.id)
     await message.reply_text("⛔ All downloads cancelled!")
 
 
 async def main():
-    runner = web.AppRunner(web_app)
-    await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", PORT)
-    await site.start()
-    logger.info(f"✅ Web server started on port {PORT}")
+    # Created here rather than at import, the forkserver and video workers
+    # import this module too and would leave a directory per pid
+    DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    # The forkserver starts before sockets and threads exist. The bot
+    # front-end never downloads, it needs no workers.
+    if ROLE != "bot":
+        video_pool.start()
+    get_http_session()
+    evict_orphans()
+    janitor = asyncio.create_task(disk_janitor())
+    lag_watch = asyncio.create_task(watch_loop_lag())
+    
+    runner = None
+    port = WORKER_PORT if ROLE == "worker" else PORT
+    if port:
+        runner = web.AppRunner(web_app)
+        await runner.setup()
+        site = web.TCPSite(runner, "0.0.0.0", port)
+        await site.start()
+        logger.info(f"✅ Web server started on port {port}")
     
     await app.start()
-    logger.info("✅ Bot v7.0 started successfully!")
+    logger.info(f"✅ Bot v7.0 started successfully! (role: {ROLE})")
+    worker = None
+    if ROLE == "worker":
+        worker = asyncio.create_task(worker_loop())
+    elif ROLE == "all":
+        await resume_batches()
     
-    await idle()
+    try:
+        await idle()
+    finally:
+        if worker:
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+        janitor.cancel()
+        lag_watch.cancel()
+        await app.stop()
+        await close_http_session()
+        if runner:
+            await runner.cleanup()
+        await video_pool.shutdown()
+        logger.info(f"HTTP connections: {http_stats}")
 
 
 if __name__ == "__main__":